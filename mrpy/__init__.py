@@ -1,5 +1,9 @@
 from .mrtrix import *
+from .tck import *
+from .streamlines import *
 from .ara import *
 from .utils import *
 from .vis import *
 from .spectra import *
+from .pipeline import *
+from .sweep import *
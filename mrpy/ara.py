@@ -2,16 +2,51 @@
 Functions for interacting with the Allen Mouse Brain Connectivity Atlas
 '''
 
+import os
+import json
+import time
+import hashlib
 import nrrd
+import shutil
+import threading
+import http.client
+import urllib.error
+import urllib.request
 import numpy as np
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
-from allensdk.api.queries.grid_data_api import GridDataApi
-from os.path import expanduser
+from os.path import expanduser, abspath
+from .utils import compact_mask, downsample_volume
 
 # Default manifest file location is user's home directory
 home = expanduser('~')
 manifest_file = home + '/mouse_connectivity/manifest.json'
 
+# Allen Brain Atlas API, used for direct grid data downloads
+api_url = 'http://api.brain-map.org'
+
+# On-disk cache of reoriented volumes as .npy files. Defaults to a
+# "reoriented" folder next to the manifest file (see set_volume_cache).
+volume_cache_dir = None
+volume_cache_max_bytes = 16 * 2**30
+_volume_cache_lock = threading.Lock()
+
+# Array encoding of the structure hierarchy. Arrays are aligned with the sorted
+# structure ids; structure j descends from (or is) structure i iff
+# enter[i] <= enter[j] < exit[i] (Euler tour intervals).
+StructureIndex = namedtuple('StructureIndex', ['ids', 'acronyms', 'parent',
+                                               'depth', 'enter', 'exit'])
+
+# Process-wide pool of MouseConnectivityCache, StructureTree and StructureIndex
+# objects, keyed by (resolution, manifest path). Guarded by _pool_lock.
+_pool_lock = threading.RLock()
+_mcc_pool = {}
+_tree_pool = {}
+_index_pool = {}
+_pool_stats = {'mcc_hits': 0, 'mcc_misses': 0,
+               'tree_hits': 0, 'tree_misses': 0}
+
 
 def make_aff(val):
     '''
@@ -46,27 +81,379 @@ def set_manifest(fn):
     manifest_file = fn
 
 
-def get_mcc(res=50, manifest_file=manifest_file):
+def set_volume_cache(path=None, max_bytes=None):
+    '''
+    Configures the on-disk cache of reoriented Allen volumes.
+
+    Parameters
+    __________
+    path : str
+        Cache directory. None resets to the default, a "reoriented" folder next
+        to the manifest file.
+    max_bytes : int
+        Size cap in bytes. Least recently used volumes are evicted past it.
+    '''
+    global volume_cache_dir, volume_cache_max_bytes
+    volume_cache_dir = path
+    if max_bytes is not None:
+        volume_cache_max_bytes = max_bytes
+
+
+def _volume_cache_path():
+    if volume_cache_dir is not None:
+        return volume_cache_dir
+    return os.path.join(os.path.dirname(abspath(expanduser(manifest_file))),
+                        'reoriented')
+
+
+def _evict_volume_cache(keep=None):
+    '''
+    Deletes least recently used cached volumes until the cache fits under
+    volume_cache_max_bytes. Access times are tracked through file mtimes.
+    '''
+    cache_dir = _volume_cache_path()
+    entries = []
+    for name in os.listdir(cache_dir):
+        fn = os.path.join(cache_dir, name)
+        if name.endswith('.npy') and fn != keep:
+            st = os.stat(fn)
+            entries.append((st.st_mtime, st.st_size, fn))
+
+    total = sum(entry[1] for entry in entries)
+    if keep is not None:
+        total += os.path.getsize(keep)
+    for _, size, fn in sorted(entries):
+        if total <= volume_cache_max_bytes:
+            break
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _volume_cache_file(kind, ident, res):
+    ident = str(ident).replace(os.sep, '_')
+    return os.path.join(_volume_cache_path(), f'{kind}_{ident}_{res}.npy')
+
+
+def _cached_volume(kind, ident, res, load, rebuild=False):
+    '''
+    Returns the reoriented volume for (kind, ident, res) as a copy-on-write
+    np.memmap from the volume cache, calling load() to build and store it on a
+    miss, or unconditionally if rebuild is True.
+    '''
+    fn = _volume_cache_file(kind, ident, res)
+
+    if os.path.exists(fn) and not rebuild:
+        try:
+            data = np.load(fn, mmap_mode='c')
+            os.utime(fn)
+            return data
+        except (OSError, ValueError):
+            pass  # truncated or unreadable entry, rebuild below
+
+    data = np.ascontiguousarray(load())
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    tmp = f'{fn}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp, fn)
+
+    with _volume_cache_lock:
+        _evict_volume_cache(keep=fn)
+    return np.load(fn, mmap_mode='c')
+
+
+def _pool_key(res, fn=None):
+    '''
+    Builds the pool key for a resolution and manifest file. Uses the current
+    module manifest file if fn is None.
+    '''
+    if res not in [100, 50, 25, 10]:
+        raise ValueError('Res must be 100, 50, 25, or 10')
+
+    if fn is None:
+        fn = manifest_file
+    return res, abspath(expanduser(fn))
+
+
+def get_mcc(res=50, manifest_file=None):
     '''
     Fetches MouseConnectivityCache object to interact with Allen data. Defaults
     to setting manifest file to user's home directory.
 
+    Objects are pooled process-wide by (resolution, manifest path), so repeated
+    calls return the same instance. Use clear_mcc_pool to invalidate.
+
     Parameters
     __________
     res : int
         Sets voxel size for Allen data. Must be 100, 50, 25, or 10.
         Default is 50.
     manifest_file : str
-        Sets location of manifest file
+        Sets location of manifest file. Defaults to the current module
+        manifest file (see set_manifest).
 
     Returns
     _______
     MouseConnectivityCache object.
     '''
-    if res not in [100, 50, 25, 10]:
-        raise ValueError('Res must be 100, 50, 25, or 10')
+    key = _pool_key(res, manifest_file)
+
+    with _pool_lock:
+        if key in _mcc_pool:
+            _pool_stats['mcc_hits'] += 1
+        else:
+            _pool_stats['mcc_misses'] += 1
+            _mcc_pool[key] = MouseConnectivityCache(resolution=key[0],
+                                                    manifest_file=key[1])
+        return _mcc_pool[key]
+
+
+def get_structure_tree(res=50, manifest_file=None):
+    '''
+    Fetches the Allen StructureTree object, pooled process-wide by
+    (resolution, manifest path) so the structure ontology is only loaded and
+    parsed once.
+
+    Parameters
+    __________
+    res : int
+        Sets voxel size for Allen data. Must be 100, 50, 25, or 10.
+        Default is 50.
+    manifest_file : str
+        Sets location of manifest file. Defaults to the current module
+        manifest file (see set_manifest).
+
+    Returns
+    _______
+    StructureTree object.
+    '''
+    key = _pool_key(res, manifest_file)
+
+    with _pool_lock:
+        if key in _tree_pool:
+            _pool_stats['tree_hits'] += 1
+        else:
+            _pool_stats['tree_misses'] += 1
+            _tree_pool[key] = get_mcc(*key).get_structure_tree()
+        return _tree_pool[key]
+
+
+def _build_structure_index(tree):
+    '''
+    Builds a StructureIndex from an allensdk StructureTree
+    '''
+    nodes = sorted(tree.nodes(), key=lambda node: node['id'])
+    ids = np.array([node['id'] for node in nodes])
+    paths = [tuple(node['structure_id_path']) for node in nodes]
+    pos = {sid: i for i, sid in enumerate(ids)}
+
+    parent = np.array([pos[path[-2]] if len(path) > 1 else -1
+                       for path in paths])
+    depth = np.array([len(path) - 1 for path in paths])
+
+    # Preorder traversal is the lexicographic order of the id paths
+    enter = np.empty(len(ids), dtype=int)
+    enter[sorted(range(len(ids)), key=paths.__getitem__)] = np.arange(len(ids))
+    size = np.zeros(len(ids), dtype=int)
+    for path in paths:
+        for sid in path:
+            size[pos[sid]] += 1
+
+    acronyms = np.array([node['acronym'] for node in nodes])
+    return StructureIndex(ids, acronyms, parent, depth, enter, enter + size)
+
+
+def get_structure_index(res=50, manifest_file=None, rebuild=False):
+    '''
+    Fetches the array-encoded structure hierarchy. The index is built once from
+    the structure tree, saved as structure_index.npz next to the manifest file
+    so later processes load it directly, and pooled like get_mcc.
+
+    Parameters
+    __________
+    res : int
+        Sets voxel size for Allen data. Must be 100, 50, 25, or 10.
+        Default is 50.
+    manifest_file : str
+        Sets location of manifest file. Defaults to the current module
+        manifest file (see set_manifest).
+    rebuild : bool
+        Rebuilds the index from the structure tree, e.g. after the ontology
+        was updated
+
+    Returns
+    _______
+    index : StructureIndex
+        Named tuple of arrays aligned with the sorted structure ids
+    '''
+    key = _pool_key(res, manifest_file)
+    fn = os.path.join(os.path.dirname(key[1]), 'structure_index.npz')
+
+    with _pool_lock:
+        if key in _index_pool and not rebuild:
+            return _index_pool[key]
+
+        if os.path.exists(fn) and not rebuild:
+            with np.load(fn) as f:
+                index = StructureIndex(*(f[field]
+                                         for field in StructureIndex._fields))
+        else:
+            index = _build_structure_index(get_structure_tree(*key))
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            tmp = f'{fn}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.savez(f, **index._asdict())
+            os.replace(tmp, fn)
 
-    return MouseConnectivityCache(resolution=res, manifest_file=manifest_file)
+        _index_pool[key] = index
+        return index
+
+
+def _index_positions(values, keys, order=None):
+    '''
+    Positions of values in keys (sorted, or sorted by order), raising KeyError
+    for values not found
+    '''
+    values = np.asarray(values)
+    sorted_keys = keys if order is None else keys[order]
+    pos = np.searchsorted(sorted_keys, values)
+    pos = np.minimum(pos, len(keys) - 1)
+    missing = sorted_keys[pos] != values
+    if missing.any():
+        raise KeyError(f'Unknown structures: {values[missing].tolist()}')
+    return pos if order is None else order[pos]
+
+
+def acronyms_to_ids(acronyms, index=None):
+    '''
+    Converts structure acronyms to ids in one vectorized lookup.
+
+    Parameters
+    __________
+    acronyms : list of str
+        Allen structure acronyms
+    index : StructureIndex
+        Structure index. Defaults to get_structure_index().
+
+    Returns
+    _______
+    ids : ndarray
+        Allen structure ids
+    '''
+    if index is None:
+        index = get_structure_index()
+    order = np.argsort(index.acronyms)
+    return index.ids[_index_positions(acronyms, index.acronyms, order)]
+
+
+def ids_to_acronyms(ids, index=None):
+    '''
+    Converts structure ids to acronyms in one vectorized lookup.
+
+    Parameters
+    __________
+    ids : list of int
+        Allen structure ids
+    index : StructureIndex
+        Structure index. Defaults to get_structure_index().
+
+    Returns
+    _______
+    acronyms : ndarray
+        Allen structure acronyms
+    '''
+    if index is None:
+        index = get_structure_index()
+    return index.acronyms[_index_positions(ids, index.ids)]
+
+
+def descends_from(structures, parents, index=None):
+    '''
+    Tests which structures descend from (or are) which parents, as a single
+    interval comparison on the Euler tour encoding. Use .any(axis=1) on the
+    result to test against any of the parents.
+
+    Parameters
+    __________
+    structures : list of int or str
+        N Allen structure ids or acronyms
+    parents : list of int or str
+        M Allen structure ids or acronyms
+    index : StructureIndex
+        Structure index. Defaults to get_structure_index().
+
+    Returns
+    _______
+    descends : ndarray
+        N x M boolean array
+    '''
+    if index is None:
+        index = get_structure_index()
+
+    def positions(structs):
+        structs = np.atleast_1d(structs)
+        if structs.dtype.kind in 'US':
+            structs = acronyms_to_ids(structs, index)
+        return _index_positions(structs, index.ids)
+
+    enter = index.enter[positions(structures)][:, None]
+    parents = positions(parents)
+    return (index.enter[parents] <= enter) & (enter < index.exit[parents])
+
+
+def clear_mcc_pool(res=None, manifest_file=None):
+    '''
+    Invalidates pooled MouseConnectivityCache, StructureTree and
+    StructureIndex objects. With no arguments the whole pool is cleared,
+    otherwise only entries matching the given resolution and/or manifest file
+    are removed.
+
+    Parameters
+    __________
+    res : int
+        Only remove entries with this voxel size
+    manifest_file : str
+        Only remove entries for this manifest file
+    '''
+    if manifest_file is not None:
+        manifest_file = abspath(expanduser(manifest_file))
+
+    with _pool_lock:
+        for pool in (_mcc_pool, _tree_pool, _index_pool):
+            for key in list(pool):
+                if ((res is None or key[0] == res) and
+                        (manifest_file is None or key[1] == manifest_file)):
+                    del pool[key]
+
+
+def mcc_pool_stats(reset=False):
+    '''
+    Returns hit/miss counters and current sizes of the MouseConnectivityCache
+    and StructureTree pool, and the size of the StructureIndex pool.
+
+    Parameters
+    __________
+    reset : bool
+        Resets the hit/miss counters to zero after reading them
+
+    Returns
+    _______
+    stats : dict
+        Counters 'mcc_hits', 'mcc_misses', 'tree_hits', 'tree_misses' and
+        pool sizes 'mcc_size', 'tree_size', 'index_size'
+    '''
+    with _pool_lock:
+        stats = dict(_pool_stats)
+        stats['mcc_size'] = len(_mcc_pool)
+        stats['tree_size'] = len(_tree_pool)
+        stats['index_size'] = len(_index_pool)
+        if reset:
+            for counter in _pool_stats:
+                _pool_stats[counter] = 0
+    return stats
 
 
 def reorient_ara_data(data):
@@ -90,7 +477,7 @@ def reorient_ara_data(data):
     return data_reoriented
 
 
-def get_structure_mask(acronym=None, res=50):
+def get_structure_mask(acronym=None, res=50, compact=None, cache=True):
     '''
     Wraps allensdk to fetch structure mask given structure acronym.
 
@@ -101,28 +488,192 @@ def get_structure_mask(acronym=None, res=50):
     res : int
         Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
         50.
+    compact : str
+        If None, returns a float mask. Otherwise returns a compact mask, one of
+        'bool', 'uint8', 'packed' or 'crop' (see utils.compact_mask).
+    cache : bool
+        If True, the reoriented volume is stored in and loaded from the on-disk
+        volume cache (see set_volume_cache) as a copy-on-write np.memmap.
 
     Returns
     _______
     aff : ndarray
         Affine matrix
-    mask : ndarray
+    mask : ndarray, PackedMask or CroppedMask
         Binary mask for given structure, in Allen CCF
     '''
 
     if res not in [100, 50, 25, 10]:
         raise ValueError('Res must be 100, 50, 25, or 10')
 
-    mcc = get_mcc(res)
-    tree = mcc.get_structure_tree()
-    ID = tree.get_structures_by_acronym([acronym])[0]['id']
-    mask, _ = mcc.get_structure_mask(ID)
-    mask = reorient_ara_data(mask)
+    def load():
+        ID = acronyms_to_ids([acronym], get_structure_index(res))[0]
+        mask, _ = get_mcc(res).get_structure_mask(ID)
+        return reorient_ara_data(mask) != 0
+
+    mask = _cached_volume('structure_mask', acronym, res,
+                          load) if cache else load()
     aff = make_aff(res / 1000)
+    if compact is not None:
+        return aff, compact_mask(mask, compact)
     return aff, mask.astype(float)
 
 
-def get_injection_density(exp_id, res=50):
+def _annotation_index(res=50):
+    '''
+    Loads the annotation volume once and converts it to indices into the sorted
+    array of structure ids (with 0 as background). Voxels annotated with ids
+    unknown to the structure tree are treated as background.
+
+    Parameters
+    __________
+    res : int
+        Sets voxel size for Allen data. Must be 100, 50, 25, or 10.
+
+    Returns
+    _______
+    ids : ndarray
+        Sorted structure ids, ids[0] == 0
+    idx : ndarray
+        uint16 index volume into ids, reoriented to neurological convention
+    '''
+    ids = np.concatenate([[0], get_structure_index(res).ids])
+    annot, _ = get_mcc(res).get_annotation_volume()
+
+    # Slab-wise lookup keeps the intp temporaries to a single slice
+    idx = np.empty(annot.shape, dtype=np.uint16)
+    for i in range(annot.shape[0]):
+        j = np.searchsorted(ids, annot[i])
+        np.minimum(j, len(ids) - 1, out=j)
+        j[ids[j] != annot[i]] = 0
+        idx[i] = j
+
+    return ids, reorient_ara_data(idx)
+
+
+def _membership(index, ids, acronyms):
+    '''
+    Builds a boolean (len(ids), len(acronyms)) table marking which structure
+    ids descend from (or are) each requested structure. ids must be the
+    index ids with 0 (background) prepended.
+    '''
+    parents = acronyms_to_ids(acronyms, index)
+    member = np.zeros((len(ids), len(parents)), dtype=bool)
+    member[1:] = descends_from(index.ids, parents, index)
+    depth = index.depth[_index_positions(parents, index.ids)]
+    return member, depth
+
+
+def get_structure_masks(acronyms, res=50, labels=False, compact=None):
+    '''
+    Builds masks for many structures from a single annotation volume. The
+    annotation is loaded and reoriented once and every mask is gathered from a
+    per-structure lookup table, instead of fetching one mask file per
+    structure as in get_structure_mask.
+
+    Parameters
+    __________
+    acronyms : list of str
+        Allen structure acronyms
+    res : int
+        Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
+        50.
+    labels : bool
+        If True, returns a single integer label volume instead of a dict of
+        masks. Voxels in acronyms[i] are labeled i + 1 and background is 0.
+        Where requested structures overlap, the most specific (deepest)
+        structure wins.
+    compact : str
+        If None, masks are float arrays. Otherwise each mask is a compact mask,
+        one of 'bool', 'uint8', 'packed' or 'crop' (see utils.compact_mask).
+        Ignored if labels is True.
+
+    Returns
+    _______
+    aff : ndarray
+        Affine matrix
+    masks : dict or ndarray
+        Dict mapping acronym to binary mask, or label volume if labels is True,
+        in Allen CCF
+    '''
+
+    if res not in [100, 50, 25, 10]:
+        raise ValueError('Res must be 100, 50, 25, or 10')
+
+    acronyms = list(acronyms)
+    ids, idx = _annotation_index(res)
+    member, depth = _membership(get_structure_index(res), ids, acronyms)
+    aff = make_aff(res / 1000)
+
+    if labels:
+        dtype = np.uint16 if len(acronyms) < 2**16 else np.uint32
+        lut = np.zeros(len(ids), dtype=dtype)
+        for i in np.argsort(depth, kind='stable'):
+            lut[member[:, i]] = i + 1
+        return aff, lut[idx]
+
+    if compact is not None:
+        masks = {acro: compact_mask(member[:, i][idx], compact)
+                 for i, acro in enumerate(acronyms)}
+    else:
+        masks = {acro: member[:, i][idx].astype(float)
+                 for i, acro in enumerate(acronyms)}
+    return aff, masks
+
+
+def _crop_to_roi(data, roi, res, units='vox'):
+    '''
+    Crops a reoriented volume to a region of interest and returns the affine
+    of the cropped volume. When data is a memmap only the cropped region is
+    read from disk.
+
+    Parameters
+    __________
+    data : ndarray
+        Reoriented volume
+    roi : str or sequence
+        Allen structure acronym, or three (start, stop) pairs or slices
+    res : int
+        Voxel size of data in microns
+    units : str
+        Units of (start, stop) pairs, 'vox' or 'mm'
+
+    Returns
+    _______
+    aff : ndarray
+        Affine matrix of the cropped volume
+    cropped : ndarray
+        Cropped volume
+    '''
+    vox = res / 1000
+    if isinstance(roi, str):
+        _, mask = get_structure_mask(roi, res, compact='crop')
+        bbox = tuple(slice(o, o + n)
+                     for o, n in zip(mask.offset, mask.data.shape))
+    else:
+        if len(roi) != 3:
+            raise ValueError('roi must have three (start, stop) pairs')
+        bbox = []
+        for bounds in roi:
+            if isinstance(bounds, slice):
+                bounds = (bounds.start, bounds.stop)
+            start, stop = bounds
+            if units == 'mm':
+                start = None if start is None else int(np.floor(start / vox))
+                stop = None if stop is None else int(np.floor(stop / vox)) + 1
+            elif units != 'vox':
+                raise ValueError("roi_units must be 'vox' or 'mm'")
+            bbox.append(slice(start, stop))
+        bbox = tuple(slice(*sl.indices(n)[:2])
+                     for sl, n in zip(bbox, data.shape))
+
+    aff = make_aff(vox)
+    aff[:3, 3] = [sl.start * vox for sl in bbox]
+    return aff, np.array(data[bbox])
+
+
+def get_injection_density(exp_id, res=50, cache=True, roi=None,
+                          roi_units='vox'):
     '''
     Wraps allensdk to fetch injection density given experiment ID
 
@@ -133,11 +684,20 @@ def get_injection_density(exp_id, res=50):
     res : int
         Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
         50.
+    cache : bool
+        If True, the reoriented volume is stored in and loaded from the on-disk
+        volume cache (see set_volume_cache) as a copy-on-write np.memmap.
+    roi : str or sequence
+        If given, only this region is returned. Either an Allen structure
+        acronym, whose bounding box is used, or three (start, stop) pairs
+        (or slices) along the axes of the reoriented volume.
+    roi_units : str
+        Units of a (start, stop) roi, 'vox' or 'mm'
 
     Returns
     _______
     aff : ndarray
-        Affine matrix
+        Affine matrix, offset to the start of the roi if given
     inj : ndarray
         Injection density image for given experiment, in Allen CCF
     '''
@@ -145,14 +705,20 @@ def get_injection_density(exp_id, res=50):
     if res not in [100, 50, 25, 10]:
         raise ValueError('Res must be 100, 50, 25, or 10')
 
-    mcc = get_mcc(res)
-    inj, _ = mcc.get_injection_density(exp_id)
-    inj = reorient_ara_data(inj)
+    def load():
+        inj, _ = get_mcc(res).get_injection_density(exp_id)
+        return reorient_ara_data(inj)
+
+    inj = _cached_volume('injection_density', exp_id, res,
+                         load) if cache else load()
+    if roi is not None:
+        return _crop_to_roi(inj, roi, res, roi_units)
     aff = make_aff(res / 1000)
     return aff, inj
 
 
-def get_projection_density(exp_id, res=50):
+def get_projection_density(exp_id, res=50, cache=True, roi=None,
+                           roi_units='vox'):
     '''
     Wraps allensdk to fetch projection density given experiment ID
 
@@ -163,11 +729,20 @@ def get_projection_density(exp_id, res=50):
     res : int
         Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
         50.
+    cache : bool
+        If True, the reoriented volume is stored in and loaded from the on-disk
+        volume cache (see set_volume_cache) as a copy-on-write np.memmap.
+    roi : str or sequence
+        If given, only this region is returned. Either an Allen structure
+        acronym, whose bounding box is used, or three (start, stop) pairs
+        (or slices) along the axes of the reoriented volume.
+    roi_units : str
+        Units of a (start, stop) roi, 'vox' or 'mm'
 
     Returns
     _______
     aff : ndarray
-        Affine matrix
+        Affine matrix, offset to the start of the roi if given
     proj : ndarray
         Projection density image for given experiment, in Allen CCF
     '''
@@ -175,16 +750,24 @@ def get_projection_density(exp_id, res=50):
     if res not in [100, 50, 25, 10]:
         raise ValueError('Res must be 100, 50, 25, or 10')
 
-    mcc = get_mcc(res)
-    proj, _ = mcc.get_projection_density(exp_id)
-    proj = reorient_ara_data(proj)
+    def load():
+        proj, _ = get_mcc(res).get_projection_density(exp_id)
+        return reorient_ara_data(proj)
+
+    proj = _cached_volume('projection_density', exp_id, res,
+                          load) if cache else load()
+    if roi is not None:
+        return _crop_to_roi(proj, roi, res, roi_units)
     aff = make_aff(res / 1000)
     return aff, proj
 
 
-def get_projection_energy(exp_id, res=50):
+def get_projection_energy(exp_id, res=50, cache=True, verify=False,
+                          refresh=False, roi=None, roi_units='vox'):
     '''
-    Wraps allensdk to fetch projection energy given experiment ID
+    Fetches projection energy given experiment ID. The NRRD file is only
+    downloaded if it is missing or fails its freshness check, so warm calls
+    read from disk only.
 
     Parameters
     __________
@@ -193,11 +776,26 @@ def get_projection_energy(exp_id, res=50):
     res : int
         Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
         50.
+    cache : bool
+        If True, the reoriented volume is stored in and loaded from the on-disk
+        volume cache (see set_volume_cache) as a copy-on-write np.memmap.
+    verify : bool
+        If True, checks the local file against its recorded MD5 checksum
+        instead of only its size
+    refresh : bool
+        If True, asks the server whether the file changed, using the stored
+        ETag, and downloads it again if so
+    roi : str or sequence
+        If given, only this region is returned. Either an Allen structure
+        acronym, whose bounding box is used, or three (start, stop) pairs
+        (or slices) along the axes of the reoriented volume.
+    roi_units : str
+        Units of a (start, stop) roi, 'vox' or 'mm'
 
     Returns
     _______
     aff : ndarray
-        Affine matrix
+        Affine matrix, offset to the start of the roi if given
     energy : ndarray
         Projection energy image for given experiment, in Allen CCF
     '''
@@ -205,13 +803,434 @@ def get_projection_energy(exp_id, res=50):
     if res not in [100, 50, 25, 10]:
         raise ValueError('Res must be 100, 50, 25, or 10')
 
-    fn = manifest_file.split('manifest.json')[
-        0] + f'/experiment_{exp_id}/projection_energy_{res}.nrrd'
-    gda = GridDataApi(res)
-    gda.download_projection_grid_data(exp_id, image=['projection_energy'],
-                                      resolution=res,
-                                      save_file_path=fn)
-    energy, _ = nrrd.read(fn)
-    energy = reorient_ara_data(energy)
+    fn, updated = _ensure_grid_data(exp_id, 'projection_energy', res,
+                                    verify=verify, refresh=refresh)
+
+    def load():
+        energy, _ = nrrd.read(fn)
+        return reorient_ara_data(energy)
+
+    energy = _cached_volume('projection_energy', exp_id, res, load,
+                            rebuild=updated) if cache else load()
+    if roi is not None:
+        return _crop_to_roi(energy, roi, res, roi_units)
     aff = make_aff(res / 1000)
     return aff, energy
+
+
+def get_projection_energies(exp_ids, res=50, max_workers=8, progress=None):
+    '''
+    Fetches projection energy for many experiments, downloading missing or
+    stale files concurrently (see prefetch_experiments).
+
+    Parameters
+    __________
+    exp_ids : list of int
+        Allen experiment IDs
+    res : int
+        Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
+        50.
+    max_workers : int
+        Maximum number of concurrent downloads
+    progress : callable
+        Called as progress(n_done, n_total, key) as each volume finishes
+
+    Returns
+    _______
+    aff : ndarray
+        Affine matrix
+    energies : dict
+        Maps experiment ID to projection energy image, in Allen CCF
+    '''
+    results, failed = prefetch_experiments(exp_ids, 'projection_energy',
+                                           res=res, max_workers=max_workers,
+                                           decode=True, progress=progress)
+    if failed:
+        err = next(iter(failed.values()))
+        raise RuntimeError(f'Failed to fetch projection energy for '
+                           f'{sorted(k[0] for k in failed)}') from err
+
+    energies = {key[0]: data for key, (_, data) in results.items()}
+    return make_aff(res / 1000), energies
+
+
+def get_projection_matrix(exp_ids, acronyms, res=50, stat='sum',
+                          kind='projection_density', threshold=0,
+                          max_workers=4, progress=None, cache=False):
+    '''
+    Summarizes density volumes within structures for many experiments. The
+    annotation is indexed once and each experiment is reduced in a single
+    np.bincount pass over the volume, with experiments processed in parallel.
+
+    Parameters
+    __________
+    exp_ids : list of int
+        Allen experiment IDs
+    acronyms : list of str
+        Allen structure acronyms. Structures may overlap.
+    res : int
+        Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
+        50.
+    stat : str
+        'sum' of density within each structure, 'mean' density, or 'fraction'
+        of structure voxels with density above threshold
+    kind : str
+        'projection_density', 'injection_density' or 'projection_energy'
+    threshold : float
+        Density threshold for stat='fraction'
+    max_workers : int
+        Maximum number of experiments processed concurrently
+    progress : callable
+        Called as progress(n_done, n_total, exp_id) as each experiment finishes
+    cache : bool
+        If True, reoriented volumes are stored in the on-disk volume cache.
+        Off by default, so that one pass over many experiments does not evict
+        useful cache entries.
+
+    Returns
+    _______
+    matrix : ndarray
+        len(exp_ids) x len(acronyms) array of summary values
+    '''
+
+    if res not in [100, 50, 25, 10]:
+        raise ValueError('Res must be 100, 50, 25, or 10')
+
+    fetchers = {'projection_density': get_projection_density,
+                'injection_density': get_injection_density,
+                'projection_energy': get_projection_energy}
+    if kind not in fetchers:
+        raise ValueError(f'Kind must be one of {list(fetchers)}')
+    if stat not in ['sum', 'mean', 'fraction']:
+        raise ValueError("Stat must be 'sum', 'mean', or 'fraction'")
+
+    ids, idx = _annotation_index(res)
+    member, _ = _membership(get_structure_index(res), ids, list(acronyms))
+    member = member.astype(float)
+    # np.bincount casts its input to intp, so the cast is done once and
+    # shared by all workers
+    idx = np.ravel(idx).astype(np.intp)
+    volume = np.bincount(idx, minlength=len(ids)) @ member
+
+    def reduce(exp_id):
+        _, data = fetchers[kind](exp_id, res, cache=cache)
+        data = np.ravel(data)
+        if stat == 'fraction':
+            data = data > threshold
+        return np.bincount(idx, weights=data, minlength=len(ids)) @ member
+
+    matrix = np.zeros((len(exp_ids), member.shape[1]))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(reduce, exp_id): i
+                   for i, exp_id in enumerate(exp_ids)}
+        for n_done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            matrix[i] = future.result()
+            if progress is not None:
+                progress(n_done, len(exp_ids), exp_ids[i])
+
+    if stat != 'sum':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            matrix /= volume
+    return matrix
+
+
+def get_pyramid(ident, kind='projection_density', levels=(100, 50, 25),
+                method=None, cache=True):
+    '''
+    Builds a multi-resolution pyramid from as few downloads as possible. The
+    finest requested level is fetched and coarser levels are derived locally
+    by block pooling. A level that is not an integer multiple of any fetched
+    level (e.g. 25 from 10) is fetched separately. Derived levels are stored in
+    the volume cache under "{kind}_pyramid_{method}_{source level}" and are
+    rebuilt when the source level is fetched again.
+
+    Parameters
+    __________
+    ident : int or str
+        Allen experiment ID, or structure acronym if kind is 'structure_mask'
+    kind : str
+        'projection_density', 'injection_density', 'projection_energy' or
+        'structure_mask'
+    levels : list of int
+        Voxel sizes to return, from 100, 50, 25, and 10
+    method : str
+        Pooling method for downsample_volume. Defaults to 'mean' for
+        densities and 'majority' for structure masks.
+    cache : bool
+        If True, fetched and derived levels use the on-disk volume cache
+
+    Returns
+    _______
+    pyramid : dict
+        Maps voxel size to (aff, data)
+    '''
+    def structure_mask(acronym, res, cache):
+        return get_structure_mask(acronym, res, compact='bool', cache=cache)
+
+    fetchers = {'projection_density': get_projection_density,
+                'injection_density': get_injection_density,
+                'projection_energy': get_projection_energy,
+                'structure_mask': structure_mask}
+    if kind not in fetchers:
+        raise ValueError(f'Kind must be one of {list(fetchers)}')
+    if method is None:
+        method = 'majority' if kind == 'structure_mask' else 'mean'
+
+    pyramid = {}
+    fetched = []
+    for res in sorted(set(levels)):
+        if res not in [100, 50, 25, 10]:
+            raise ValueError('Res must be 100, 50, 25, or 10')
+
+        sources = [src for src in fetched if res % src == 0]
+        if not sources:
+            pyramid[res] = fetchers[kind](ident, res, cache=cache)
+            fetched.append(res)
+            continue
+
+        src = max(sources)
+        fine = pyramid[src][1]
+        if cache:
+            # Keyed by method, source level and the inode of the cached
+            # source, which changes whenever the source is fetched again
+            stamp = os.stat(_volume_cache_file(kind, ident, src)).st_ino
+            data = _cached_volume(f'{kind}_pyramid_{method}_{src}',
+                                  f'{ident}_{stamp}', res,
+                                  lambda: downsample_volume(fine, res // src,
+                                                            method))
+        else:
+            data = downsample_volume(fine, res // src, method)
+        pyramid[res] = make_aff(res / 1000), data
+
+    return pyramid
+
+
+def _grid_data_path(exp_id, kind, res, manifest_file=None):
+    '''
+    Path of a grid data volume in the MouseConnectivityCache directory layout
+    '''
+    manifest_dir = os.path.dirname(_pool_key(res, manifest_file)[1])
+    return os.path.join(manifest_dir, f'experiment_{exp_id}',
+                        f'{kind}_{res}.nrrd')
+
+
+def _md5(fn, chunk_size=2**20):
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _record_download(fn, etag=None):
+    '''
+    Writes the "fn.json" sidecar holding size, MD5 and ETag of a downloaded
+    file
+    '''
+    meta = {'size': os.path.getsize(fn), 'md5': _md5(fn), 'etag': etag}
+    with open(fn + '.json', 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def _is_fresh(fn, verify=False):
+    '''
+    Checks a downloaded file against its sidecar. Files without a sidecar
+    (e.g. fetched by allensdk) are adopted as they are.
+    '''
+    if not os.path.exists(fn):
+        return False
+    try:
+        with open(fn + '.json') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        _record_download(fn)
+        return True
+
+    if os.path.getsize(fn) != meta['size']:
+        return False
+    return not verify or _md5(fn) == meta['md5']
+
+
+def _download(url, fn, timeout=60, chunk_size=2**20, etag=None):
+    '''
+    Downloads url to fn through a "fn.part" file. An existing partial file is
+    resumed with an HTTP Range request. Raises IOError if the transfer ends
+    short of the advertised length, leaving the partial file for a retry.
+    If etag is given the request is conditional and nothing is downloaded when
+    the server reports the file unchanged.
+
+    Returns
+    _______
+    downloaded : bool
+        False if the server reported the file unchanged
+    '''
+    part = fn + '.part'
+    start = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': f'bytes={start}-'} if start else {}
+    if etag is not None and not start:
+        headers['If-None-Match'] = etag
+
+    try:
+        resp = urllib.request.urlopen(urllib.request.Request(url,
+                                                             headers=headers),
+                                      timeout=timeout)
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            return False
+        # Partial file already holds the whole payload
+        if err.code == 416 and start:
+            os.replace(part, fn)
+            _record_download(fn)
+            return True
+        raise
+
+    with resp:
+        if start and resp.status != 206:
+            start = 0  # server ignored the range request
+        length = resp.headers.get('Content-Length')
+        with open(part, 'ab' if start else 'wb') as f:
+            shutil.copyfileobj(resp, f, chunk_size)
+
+    if length is not None and os.path.getsize(part) != start + int(length):
+        raise IOError(f'Incomplete download of {url}')
+    os.replace(part, fn)
+    _record_download(fn, resp.headers.get('ETag'))
+    return True
+
+
+def _ensure_grid_data(exp_id, kind, res, retries=3, backoff=1.0,
+                      base_url=None, timeout=60, verify=False, refresh=False):
+    '''
+    Makes sure one grid data volume is on disk and fresh, downloading it with
+    retries and exponential backoff if not.
+
+    Returns
+    _______
+    fn : str
+        Path of the NRRD file
+    updated : bool
+        True if the file was (re)downloaded
+    '''
+    fn = _grid_data_path(exp_id, kind, res)
+    fresh = _is_fresh(fn, verify=verify)
+    if fresh and not refresh:
+        return fn, False
+
+    etag = None
+    if fresh:
+        with open(fn + '.json') as f:
+            etag = json.load(f)['etag']
+        if etag is None:
+            return fn, False  # nothing to revalidate against
+
+    if base_url is None:
+        base_url = api_url
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    url = (f'{base_url}/grid_data/download_file/{exp_id}'
+           f'?image={kind}&resolution={res}')
+    for attempt in range(retries + 1):
+        try:
+            return fn, _download(url, fn, timeout=timeout, etag=etag)
+        except urllib.error.HTTPError as err:
+            # Client errors such as 404 are permanent, except timeouts,
+            # rate limiting and 416 on a stale partial file
+            if (400 <= err.code < 500 and err.code not in (408, 416, 429)
+                    or attempt == retries):
+                raise
+            time.sleep(backoff * 2**attempt)
+        except (IOError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def _fetch_grid_data(exp_id, kind, res, decode, retries, backoff, base_url,
+                     timeout):
+    '''
+    Downloads (if needed) and optionally decodes one grid data volume
+    '''
+    fn, updated = _ensure_grid_data(exp_id, kind, res, retries=retries,
+                                    backoff=backoff, base_url=base_url,
+                                    timeout=timeout)
+    if not decode:
+        return fn
+    data = _cached_volume(kind, exp_id, res,
+                          lambda: reorient_ara_data(nrrd.read(fn)[0]),
+                          rebuild=updated)
+    return make_aff(res / 1000), data
+
+
+def prefetch_experiments(exp_ids, kinds='projection_density', res=50,
+                         max_workers=8, decode=False, retries=3, backoff=1.0,
+                         progress=None, base_url=None, timeout=60):
+    '''
+    Downloads grid data volumes for many experiments concurrently into the
+    MouseConnectivityCache directory, so later calls to the single-experiment
+    fetchers read from disk. Files already present and matching their recorded
+    size are not downloaded again, and interrupted downloads are resumed.
+
+    Parameters
+    __________
+    exp_ids : list of int
+        Allen experiment IDs
+    kinds : str or list of str
+        Grid data volumes to fetch, e.g. 'injection_density',
+        'projection_density' or 'projection_energy'
+    res : int
+        Sets voxel size for Allen data. Must be 100, 50, 25, or 10. Default is
+        50.
+    max_workers : int
+        Maximum number of concurrent downloads
+    decode : bool
+        If True, results hold (aff, data) tuples of reoriented volumes instead
+        of file paths, and the volumes are stored in the volume cache
+    retries : int
+        Number of retries per volume after the first failed attempt
+    backoff : float
+        Initial retry delay in seconds, doubled after every attempt
+    progress : callable
+        Called as progress(n_done, n_total, key) as each volume finishes,
+        where key is (exp_id, kind)
+    base_url : str
+        API base URL. Defaults to the module api_url; useful for pointing at a
+        local mirror or test server.
+    timeout : float
+        Socket timeout in seconds
+
+    Returns
+    _______
+    results : dict
+        Maps (exp_id, kind) to file path, or to (aff, data) if decode is True
+    failed : dict
+        Maps (exp_id, kind) to the exception raised after the last retry
+    '''
+
+    if res not in [100, 50, 25, 10]:
+        raise ValueError('Res must be 100, 50, 25, or 10')
+
+    if isinstance(kinds, str):
+        kinds = [kinds]
+    if base_url is None:
+        base_url = api_url
+
+    # Duplicates would make two workers write the same .part file
+    keys = list(dict.fromkeys((exp_id, kind) for exp_id in exp_ids
+                              for kind in kinds))
+    results = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_fetch_grid_data, exp_id, kind, res, decode,
+                               retries, backoff, base_url, timeout):
+                   (exp_id, kind) for exp_id, kind in keys}
+        for n_done, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as err:
+                failed[key] = err
+            if progress is not None:
+                progress(n_done, len(keys), key)
+
+    return results, failed
@@ -7,12 +7,188 @@ tcksift2
 tck2connectome
 '''
 
+import os
+import re
+import sys
+import glob
+import json
+import time
 import numpy as np
+import threading
 import subprocess
 import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from .tck import merge_tck
 
 n_cpus = multiprocessing.cpu_count()
 
+# Set on JobScheduler worker threads so that _run_mrtrix can register the
+# processes it starts with the running job
+_current = threading.local()
+
+# Optional JSONL file that every wrapper call appends its RunResult to (see
+# set_run_log)
+run_log = None
+_run_log_lock = threading.Lock()
+
+# MRtrix3 progress lines look like "tckgen: [ 45%] generating streamlines..."
+_progress_re = re.compile(r'\[\s*(\d+)%\]\s*(.*)')
+
+# Seconds between samples of the peak memory of running MRtrix3 processes
+_rss_interval = 0.1
+
+# Telemetry of one MRtrix3 call. args and returncode match
+# subprocess.CompletedProcess. Times are in seconds. cpu_time is None where
+# os.wait4 is unavailable. max_rss is the peak resident memory (VmHWM) of the
+# MRtrix3 process in bytes, sampled from /proc every _rss_interval seconds, so
+# it is None without /proc or for processes that exit before the first
+# sample. (ru_maxrss is not used: on Linux it includes the forked Python
+# parent.) progress holds (elapsed seconds, percent, message) updates parsed
+# from stderr.
+RunResult = namedtuple('RunResult', ['args', 'returncode', 'start_time',
+                                     'wall_time', 'cpu_time', 'max_rss',
+                                     'progress'])
+
+
+def set_run_log(fn):
+    '''
+    Sets a JSONL file that every MRtrix3 wrapper call appends its RunResult
+    to. None disables logging.
+
+    Parameters
+    __________
+    fn : str
+        Run log filename
+    '''
+    global run_log
+    run_log = fn
+
+
+def _log_run(result):
+    record = result._asdict()
+    record['command'] = ' '.join(result.args)
+    with _run_log_lock:
+        with open(run_log, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def _watch_stderr(stream, progress, t0):
+    '''
+    Forwards a process' stderr to sys.stderr while collecting progress
+    updates, keeping only the last update of each percent level
+    '''
+    buf = ''
+    while True:
+        chunk = stream.read1(2**16) if hasattr(stream, 'read1') else \
+            stream.read(2**16)
+        if not chunk:
+            break
+        text = chunk.decode(errors='replace')
+        sys.stderr.write(text)
+        *lines, buf = re.split(r'[\r\n]', buf + text)
+        for line in lines:
+            match = _progress_re.search(line)
+            if match is None:
+                continue
+            update = (round(time.time() - t0, 3), int(match.group(1)),
+                      match.group(2).strip())
+            if progress and progress[-1][1:] == update[1:]:
+                continue
+            if progress and progress[-1][1] == update[1]:
+                progress[-1] = update
+            else:
+                progress.append(update)
+
+
+def _watch_rss(pid, done, peak):
+    '''
+    Samples the peak resident memory of a process from /proc/<pid>/status
+    until done is set, keeping the largest value in bytes in peak[0]
+    '''
+    while True:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        rss = int(line.split()[1]) * 1024
+                        peak[0] = max(peak[0] or 0, rss)
+                        break
+        except (OSError, ValueError):
+            pass  # no /proc, or the process has exited
+        if done.wait(_rss_interval):
+            return
+
+
+def _run_mrtrix(mrtrix_call, env=None):
+    '''
+    Runs an MRtrix3 command line and records its telemetry. Processes started
+    inside a JobScheduler job are registered with the job so they can be
+    cancelled. The result is appended to run_log if set.
+
+    Parameters
+    __________
+    mrtrix_call : str
+        Command line
+    env : dict
+        Environment for the process. Defaults to the current environment.
+
+    Returns
+    _______
+    result : RunResult
+        Command line, return code, wall and CPU time, peak RSS and progress
+    '''
+    args = mrtrix_call.split(' ')
+    job = getattr(_current, 'job', None)
+    start = time.time()
+    t0 = time.perf_counter()
+
+    if job is not None:
+        job.lock.acquire()
+    try:
+        if job is not None and job.cancelled:
+            raise CancelledError()
+        proc = subprocess.Popen(args, env=env, stderr=subprocess.PIPE)
+        if job is not None:
+            job.procs.append(proc)
+    finally:
+        if job is not None:
+            job.lock.release()
+
+    progress = []
+    watcher = threading.Thread(target=_watch_stderr,
+                               args=(proc.stderr, progress, start),
+                               daemon=True)
+    watcher.start()
+    done = threading.Event()
+    peak = [None]
+    sampler = threading.Thread(target=_watch_rss,
+                               args=(proc.pid, done, peak), daemon=True)
+    sampler.start()
+    try:
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            cpu_time = usage.ru_utime + usage.ru_stime
+        else:
+            proc.wait()
+            cpu_time = None
+        wall_time = time.perf_counter() - t0
+        done.set()
+        sampler.join()
+        watcher.join()
+        proc.stderr.close()
+    finally:
+        if job is not None:
+            with job.lock:
+                job.procs.remove(proc)
+
+    result = RunResult(args, proc.returncode, start, wall_time, cpu_time,
+                       peak[0], progress)
+    if run_log is not None:
+        _log_run(result)
+    return result
+
 
 def tckgen(source, tracks, mel=False, **options):
     '''
@@ -31,6 +207,19 @@ def tckgen(source, tracks, mel=False, **options):
     options : dict
         Additional arguments. Set flag options to bool values.
 
+    Returns
+    _______
+    result : RunResult
+        Command line, return code, wall and CPU time, peak RSS and progress
+    '''
+
+    # Calls function
+    return _run_mrtrix(_tckgen_call(source, tracks, mel, **options))
+
+
+def _tckgen_call(source, tracks, mel=False, **options):
+    '''
+    Builds the tckgen command line. See tckgen.
     '''
 
     # Set default options
@@ -65,9 +254,7 @@ def tckgen(source, tracks, mel=False, **options):
         else:
             mrtrix_call += f' -{param} {val}'
     mrtrix_call += f' {source} {tracks}'
-
-    # Calls function
-    subprocess.run(mrtrix_call.split(' '))
+    return mrtrix_call
 
 
 def tckmap(tracks, output, mel=False, **options):
@@ -86,6 +273,10 @@ def tckmap(tracks, output, mel=False, **options):
     options : dict
         Additional arguments. Set flag options to bool values.
 
+    Returns
+    _______
+    result : RunResult
+        Command line, return code, wall and CPU time, peak RSS and progress
     '''
 
     # Set default options
@@ -111,7 +302,7 @@ def tckmap(tracks, output, mel=False, **options):
     mrtrix_call += f' {tracks} {output}'
 
     # Calls function
-    subprocess.run(mrtrix_call.split(' '))
+    return _run_mrtrix(mrtrix_call)
 
 
 def tcksift2(in_tracks, in_fod, out_weights, mel=False, **options):
@@ -133,6 +324,10 @@ def tcksift2(in_tracks, in_fod, out_weights, mel=False, **options):
     options : dict
         Additional arguments. Set flag options to bool values.
 
+    Returns
+    _______
+    result : RunResult
+        Command line, return code, wall and CPU time, peak RSS and progress
     '''
 
     # Set default options
@@ -157,7 +352,7 @@ def tcksift2(in_tracks, in_fod, out_weights, mel=False, **options):
     mrtrix_call += f' {in_tracks} {in_fod} {out_weights}'
 
     # Calls function
-    subprocess.run(mrtrix_call.split(' '))
+    return _run_mrtrix(mrtrix_call)
 
 
 def tck2connectome(tracks_in, nodes_in, connectome_out, mel=False, **options):
@@ -178,6 +373,10 @@ def tck2connectome(tracks_in, nodes_in, connectome_out, mel=False, **options):
     options : dict
         Additional arguments. Set flag options to bool values.
 
+    Returns
+    _______
+    result : RunResult
+        Command line, return code, wall and CPU time, peak RSS and progress
     '''
 
     # Set default options
@@ -204,4 +403,304 @@ def tck2connectome(tracks_in, nodes_in, connectome_out, mel=False, **options):
     mrtrix_call += f' {tracks_in} {nodes_in} {connectome_out}'
 
     # Calls function
-    subprocess.run(mrtrix_call.split(' '))
+    return _run_mrtrix(mrtrix_call)
+
+
+def _numa_nodes():
+    '''
+    NUMA node ids of this machine, [0] if unknown
+    '''
+    nodes = glob.glob('/sys/devices/system/node/node[0-9]*')
+    return sorted(int(node.rsplit('node', 1)[1]) for node in nodes) or [0]
+
+
+def tckgen_sharded(source, tracks, n_shards=2, numa=False, rng_seed=None,
+                   scheduler=None, keep_shards=False, mel=False, **options):
+    '''
+    Runs tckgen as n_shards independent processes, each generating its share
+    of select with a distinct random seed, and merges the shards into one
+    .tck file by streaming (see merge_tck).
+
+    Parameters
+    __________
+    source : str
+        The image containing the source data.
+    tracks : str
+        The output file containing the merged tracks.
+    n_shards : int
+        Number of tckgen processes
+    numa : bool or list of int
+        Binds shard i to a NUMA node with numactl. True cycles through all
+        nodes of the machine; a list gives the nodes to cycle through.
+    rng_seed : int
+        Base seed. Shard i runs with MRTRIX_RNG_SEED = rng_seed + i. Random
+        if None.
+    scheduler : JobScheduler
+        Scheduler to run the shards on. Defaults to a new one whose core
+        budget is nthreads.
+    keep_shards : bool
+        Keeps the shard files "{tracks}_shard{i}.tck" after merging
+    mel : bool
+        Appends 'assign-nodes' for multiprocessing on MEL workstation
+    options : dict
+        Additional tckgen arguments. select (and seeds, if given) are split
+        across shards and nthreads is divided among them. Fewer than
+        n_shards shards are used if select or seeds is smaller.
+
+    Returns
+    _______
+    count : int
+        Number of streamlines in the merged file
+    '''
+    select = int(options.pop('select', 500000))
+    seeds = options.pop('seeds', None)
+    nthreads = int(options.pop('nthreads', n_cpus))
+    if rng_seed is None:
+        rng_seed = int(np.random.SeedSequence().entropy % 2**31)
+    if numa is True:
+        numa = _numa_nodes()
+    # A shard given select=0 or seeds=0 would run without that limit, so
+    # never use more shards than there are streamlines or seeds to split
+    for total in (select, seeds):
+        if total is not None and int(total) > 0:
+            n_shards = max(1, min(n_shards, int(total)))
+
+    def split(total):
+        return [total // n_shards + (i < total % n_shards)
+                for i in range(n_shards)]
+
+    root, ext = os.path.splitext(tracks)
+    shards = [f'{root}_shard{i}{ext}' for i in range(n_shards)]
+    threads = max(1, nthreads // n_shards)
+
+    def run_shard(i, shard_select, shard_seeds):
+        shard_options = dict(options, select=shard_select, nthreads=threads)
+        if shard_seeds is not None:
+            shard_options['seeds'] = shard_seeds
+        mrtrix_call = _tckgen_call(source, shards[i], mel, **shard_options)
+        if numa:
+            node = numa[i % len(numa)]
+            mrtrix_call = (f'numactl --cpunodebind={node} --membind={node} '
+                           + mrtrix_call)
+        env = dict(os.environ, MRTRIX_RNG_SEED=str(rng_seed + i))
+        return _run_mrtrix(mrtrix_call, env=env)
+
+    futures = []
+    own = scheduler is None
+    if own:
+        scheduler = JobScheduler(max_cores=max(nthreads, n_shards),
+                                 max_jobs=n_shards)
+    try:
+        shard_seeds = split(int(seeds)) if seeds is not None else \
+            [None] * n_shards
+        futures = [scheduler.submit(run_shard, i, n, shard_seeds[i],
+                                    cores=threads)
+                   for i, n in enumerate(split(select))]
+        for future in futures:
+            future.result()
+    except BaseException:
+        for future in futures:
+            scheduler.cancel(future)
+        raise
+    finally:
+        if own:
+            scheduler.shutdown(wait=True)
+
+    return merge_tck(shards, tracks, remove=not keep_shards)
+
+
+class _Job:
+    '''
+    Bookkeeping for one JobScheduler submission
+    '''
+
+    def __init__(self, func, args, kwargs, cores):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cores = cores
+        self.cancelled = False
+        self.procs = []
+        self.lock = threading.Lock()
+
+
+class JobScheduler:
+    '''
+    Runs MRtrix3 wrapper calls concurrently under a global core budget. Each
+    job reserves a number of cores while it runs and MRtrix3 wrappers are
+    given that number as nthreads. Unless set explicitly, a job's share is
+    max_cores // max_jobs, independent of how fast jobs are submitted. The
+    last queued job, started while others are still running, takes a larger
+    share of the free cores. Can be used as a context manager.
+
+    Parameters
+    __________
+    max_cores : int
+        Total number of cores shared by all running jobs
+    max_jobs : int
+        Maximum number of jobs running at once. Defaults to max_cores.
+
+    Example
+    _______
+    >>> with JobScheduler(max_cores=32, max_jobs=4) as sched:
+    ...     futures = [sched.submit(tckgen, src, f'seed{i}.tck', seed_image=s)
+    ...                for i, s in enumerate(seeds)]
+    >>> results = [f.result() for f in futures]
+    '''
+
+    def __init__(self, max_cores=n_cpus, max_jobs=None):
+        self.max_cores = max_cores
+        self.max_jobs = max_cores if max_jobs is None else max_jobs
+        self._free = max_cores
+        self._waiting = 0
+        self._running = 0
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._pool = ThreadPoolExecutor(max_workers=self.max_jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(wait=True, cancel=exc[0] is not None)
+
+    def submit(self, func, *args, cores=None, **kwargs):
+        '''
+        Schedules func(*args, **kwargs).
+
+        Parameters
+        __________
+        func : callable
+            An MRtrix3 wrapper (tckgen, tckmap, tcksift2, tck2connectome) or
+            any callable that runs them
+        args, kwargs
+            Arguments passed to func
+        cores : int
+            Cores reserved for the job. Defaults to an explicit nthreads
+            keyword, else a fair share of the budget when the job starts.
+
+        Returns
+        _______
+        future : concurrent.futures.Future
+            Resolves to the return value of func. Raises CalledProcessError
+            if an MRtrix3 command exits non-zero.
+        '''
+        if cores is None and 'nthreads' in kwargs:
+            cores = int(kwargs['nthreads'])
+        if cores is not None:
+            cores = max(1, min(cores, self.max_cores))
+
+        job = _Job(func, args, kwargs, cores)
+        with self._cond:
+            self._waiting += 1
+            future = self._pool.submit(self._run, job)
+            self._jobs[future] = job
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._cond:
+            job = self._jobs.pop(future, None)
+            if future.cancelled() and job is not None:
+                self._waiting -= 1
+                self._cond.notify_all()
+
+    def _share(self):
+        '''
+        Default number of cores for a job about to start. Called with _cond
+        held.
+        '''
+        share = max(1, self.max_cores // self.max_jobs)
+        if self._waiting == 1 and self._running:
+            # Last queued job while others finish: take a fair share of the
+            # budget, as far as it is free
+            share = max(share, min(self._free,
+                                   self.max_cores // (self._running + 1)))
+        return share
+
+    def _run(self, job):
+        with self._cond:
+            while True:
+                if job.cancelled:
+                    self._waiting -= 1
+                    self._cond.notify_all()
+                    raise CancelledError()
+                cores = job.cores or self._share()
+                if self._free >= cores:
+                    break
+                self._cond.wait()
+            self._free -= cores
+            self._waiting -= 1
+            self._running += 1
+
+        if job.func in (tckgen, tckmap, tcksift2, tck2connectome):
+            job.kwargs.setdefault('nthreads', cores)
+
+        _current.job = job
+        try:
+            result = job.func(*job.args, **job.kwargs)
+        finally:
+            _current.job = None
+            with self._cond:
+                self._free += cores
+                self._running -= 1
+                self._cond.notify_all()
+
+        if job.cancelled:
+            raise CancelledError()
+        if getattr(result, 'returncode', 0) != 0:
+            raise subprocess.CalledProcessError(result.returncode, result.args)
+        return result
+
+    def cancel(self, future):
+        '''
+        Cancels a job. Queued jobs never start and running MRtrix3 processes
+        are terminated.
+
+        Parameters
+        __________
+        future : concurrent.futures.Future
+            Future returned by submit
+
+        Returns
+        _______
+        cancelled : bool
+            False if the job had already finished
+        '''
+        if future.cancel():
+            return True
+        with self._cond:
+            job = self._jobs.get(future)
+            if job is None:
+                return False
+            with job.lock:
+                job.cancelled = True
+            self._cond.notify_all()
+        with job.lock:
+            for proc in job.procs:
+                proc.terminate()
+        return True
+
+    def cancel_all(self):
+        '''
+        Cancels all queued and running jobs
+        '''
+        with self._cond:
+            futures = list(self._jobs)
+        for future in futures:
+            self.cancel(future)
+
+    def shutdown(self, wait=True, cancel=False):
+        '''
+        Stops accepting jobs, optionally cancelling outstanding ones.
+
+        Parameters
+        __________
+        wait : bool
+            Blocks until all jobs have finished
+        cancel : bool
+            Cancels queued and running jobs first
+        '''
+        if cancel:
+            self.cancel_all()
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,273 @@
+'''
+Incremental pipelines of MRTrix3 wrapper calls, e.g.
+
+tckgen -> tcksift2 -> tckmap / tck2connectome
+
+Each step declares its input and output files. A step is skipped when the
+content hashes of its inputs and its options match the manifest recorded by
+the last successful run and its outputs are untouched. Independent steps run
+in parallel on a JobScheduler.
+'''
+
+import os
+import json
+import hashlib
+from concurrent.futures import wait, FIRST_COMPLETED
+from .mrtrix import JobScheduler, tckgen, tckmap, tcksift2, tck2connectome
+
+# MRTrix3 options whose value is an input file. Other options (e.g. out_mu,
+# output_seeds, out_assignments) may name outputs and are never inferred as
+# inputs.
+_input_options = {'seed_image', 'seed_random_per_voxel',
+                  'seed_grid_per_voxel', 'seed_rejection', 'seed_gmwmi',
+                  'seed_dynamic', 'include', 'include_ordered', 'exclude',
+                  'mask', 'act', 'proc_mask', 'template', 'tck_weights_in',
+                  'image', 'vector_file'}
+
+
+def _file_stat(fn):
+    st = os.stat(fn)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _sha256(fn, chunk_size=2**22):
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Pipeline:
+    '''
+    A small DAG of MRTrix3 wrapper calls with skip-if-unchanged semantics.
+    Dependencies are inferred from file names: a step depends on every step
+    that outputs one of its inputs.
+
+    Parameters
+    __________
+    manifest : str
+        JSON file recording input hashes, options and outputs of completed
+        steps
+    scheduler : JobScheduler
+        Scheduler to run steps on. Defaults to a new JobScheduler using all
+        cores.
+
+    Example
+    _______
+    >>> pipe = Pipeline('run/pipeline.json')
+    >>> pipe.add('track', tckgen, 'fod.mif', 'wb.tck', seed_image='mask.nii')
+    >>> pipe.add('sift', tcksift2, 'wb.tck', 'fod.mif', 'weights.txt')
+    >>> pipe.add('tdi', tckmap, 'wb.tck', 'tdi.nii.gz', vox=0.05)
+    >>> pipe.run()
+    '''
+
+    def __init__(self, manifest='pipeline.json', scheduler=None):
+        self.manifest = manifest
+        self.scheduler = scheduler
+        self.steps = {}
+
+    def add(self, name, func, *args, inputs=None, outputs=None, **options):
+        '''
+        Adds a step calling func(*args, **options).
+
+        Parameters
+        __________
+        name : str
+            Unique step name
+        func : callable
+            MRTrix3 wrapper or other callable
+        args
+            Positional arguments for func
+        inputs : list of str
+            Input files. For the MRTrix3 wrappers defaults to all positional
+            arguments but the last. Values of MRTrix3 input options (e.g.
+            seed_image, mask, template) naming existing files or outputs of
+            other steps are always inputs. Other file options must be
+            declared here.
+        outputs : list of str
+            Output files. For the MRTrix3 wrappers defaults to the last
+            positional argument.
+        options : dict
+            Keyword arguments for func
+        '''
+        if name in self.steps:
+            raise ValueError(f'Duplicate step name {name}')
+
+        wrapper = func in (tckgen, tckmap, tcksift2, tck2connectome)
+        if inputs is None:
+            inputs = list(args[:-1]) if wrapper else []
+        if outputs is None:
+            outputs = list(args[-1:]) if wrapper else []
+
+        self.steps[name] = {'func': func, 'args': args, 'options': options,
+                            'inputs': [str(fn) for fn in inputs],
+                            'outputs': [str(fn) for fn in outputs]}
+
+    def _graph(self):
+        '''
+        Resolves option file inputs and returns the dependencies of each step
+        '''
+        producer = {}
+        for name, step in self.steps.items():
+            for fn in step['outputs']:
+                if fn in producer:
+                    raise ValueError(f'{fn} is output by both {producer[fn]} '
+                                     f'and {name}')
+                producer[fn] = name
+
+        deps = {}
+        for name, step in self.steps.items():
+            for key, val in step['options'].items():
+                if (key in _input_options and isinstance(val, str) and
+                        val not in step['inputs'] and
+                        val not in step['outputs'] and
+                        (val in producer or os.path.isfile(val))):
+                    step['inputs'].append(val)
+            deps[name] = {producer[fn] for fn in step['inputs']
+                          if fn in producer} - {name}
+        return deps
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'files': {}, 'steps': {}}
+
+    def _save_manifest(self, record):
+        tmp = self.manifest + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f, indent=1)
+        os.replace(tmp, self.manifest)
+
+    def _digest(self, fn, record):
+        '''
+        Content hash of fn, reusing the recorded hash while size and mtime
+        are unchanged
+        '''
+        stat = _file_stat(fn)
+        cached = record['files'].get(fn)
+        if cached is not None and cached[:2] == stat:
+            return cached[2]
+        digest = _sha256(fn)
+        record['files'][fn] = stat + [digest]
+        return digest
+
+    def _signature(self, step, record):
+        func = step['func']
+        sig = {'func': f'{func.__module__}.{func.__qualname__}',
+               'args': [str(arg) for arg in step['args']],
+               'options': {key: str(val)
+                           for key, val in sorted(step['options'].items())},
+               'inputs': {fn: self._digest(fn, record)
+                          for fn in sorted(step['inputs'])}}
+        return hashlib.sha256(json.dumps(sig, sort_keys=True)
+                              .encode()).hexdigest()
+
+    def _up_to_date(self, name, signature, record):
+        done = record['steps'].get(name)
+        if done is None or done['signature'] != signature:
+            return False
+        for fn, stat in done['outputs'].items():
+            if not os.path.exists(fn) or _file_stat(fn) != stat:
+                return False
+        return True
+
+    def _start(self, name, scheduler, record, force, status, errors,
+               running):
+        '''
+        Skips a step whose dependencies are done if it is up to date, and
+        submits it otherwise
+        '''
+        step = self.steps[name]
+        missing = [fn for fn in step['inputs'] if not os.path.exists(fn)]
+        if missing:
+            errors[name] = FileNotFoundError(f'Missing inputs of {name}: '
+                                             f'{missing}')
+            status[name] = 'failed'
+            return
+
+        step['signature'] = self._signature(step, record)
+        if not force and self._up_to_date(name, step['signature'], record):
+            status[name] = 'skipped'
+            return
+
+        future = scheduler.submit(step['func'], *step['args'],
+                                  **step['options'])
+        running[future] = name
+
+    def run(self, force=False):
+        '''
+        Runs all out-of-date steps, in parallel where the graph allows.
+
+        Parameters
+        __________
+        force : bool
+            Runs every step regardless of the manifest
+
+        Returns
+        _______
+        status : dict
+            Maps step name to 'skipped', 'ran', 'failed' or 'blocked' (not
+            run because a dependency failed). Raises RuntimeError after all
+            runnable steps finished if any step failed.
+        '''
+        deps = self._graph()
+        record = self._load_manifest()
+        scheduler = self.scheduler or JobScheduler()
+
+        status = {}
+        errors = {}
+        running = {}
+        pending = set(self.steps)
+        try:
+            while pending or running:
+                progressed = True
+                while progressed:
+                    progressed = False
+                    for name in sorted(pending):
+                        done = {n for n, s in status.items()
+                                if s in ('ran', 'skipped')}
+                        if deps[name] & (set(status) - done):
+                            status[name] = 'blocked'
+                        elif not deps[name] <= done:
+                            continue
+                        else:
+                            self._start(name, scheduler, record, force,
+                                        status, errors, running)
+                        pending.discard(name)
+                        progressed = True
+
+                if not running:
+                    if pending:
+                        raise ValueError(f'Dependency cycle among steps '
+                                         f'{sorted(pending)}')
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as err:
+                        errors[name] = err
+                        status[name] = 'failed'
+                        record['steps'].pop(name, None)
+                    else:
+                        outputs = self.steps[name]['outputs']
+                        record['steps'][name] = {
+                            'signature': self.steps[name]['signature'],
+                            'outputs': {fn: _file_stat(fn) for fn in outputs
+                                        if os.path.exists(fn)}}
+                        status[name] = 'ran'
+                    self._save_manifest(record)
+            self._save_manifest(record)
+        finally:
+            if self.scheduler is None:
+                scheduler.shutdown(wait=True, cancel=bool(running))
+
+        if errors:
+            err = next(iter(errors.values()))
+            raise RuntimeError(f'Pipeline steps failed: {sorted(errors)}; '
+                               f'status: {status}') from err
+        return status
@@ -1,23 +1,56 @@
 import numpy as np
+import multiprocessing
+import nibabel as nib
+from glob import glob
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.decomposition import PCA
+from scipy.linalg import eigh
 from scipy.stats import levene
+from scipy.stats import f as f_dist
 from .utils import loadnii
 
+_n_cpus = multiprocessing.cpu_count()
 
-def load_spect(fn_base, num_imgs=None, ext='.nii.gz'):
+
+def _find_slices(fn_base, ext):
+    '''
+    Numbers of the slice images {fn_base}{num}{ext}, sorted numerically
+    '''
+    nums = [fn[len(fn_base):-len(ext)] for fn in glob(f'{fn_base}*{ext}')]
+    nums = sorted((num for num in nums if num.isdigit()), key=int)
+    if not nums:
+        raise FileNotFoundError(f'No slice images {fn_base}<number>{ext}')
+    return nums
+
+
+def load_spect(fn_base, num_imgs=None, ext='.nii.gz', dtype=np.float64,
+               out=None, max_workers=_n_cpus):
     '''
     Utility function for laoding EPSI data from folder of Nifti images.
     Assumes images represent slices along dimension 3 and are labeled:
     {fn_base}/001.nii.gz, {fn_base}/002.nii.gz, etc.
 
+    Slices are decoded concurrently into a preallocated array, which may be
+    a memory-mapped .npy file so the 4D data never has to fit in RAM.
+
     Parameters
     __________
     fn_base : str
         Base file path for images
-    num_imgs : int
-        Number of images in folder
+    num_imgs : list of str
+        Image numbers, e.g. ['001', '002']. By default all images
+        {fn_base}<number>{ext} are found and sorted numerically.
     ext : str
         File extension. Should be '.nii.gz' or '.nii'
+    dtype : dtype
+        Output data type, e.g. np.float32 or np.complex64
+    out : str or ndarray
+        Output .npy filename, opened as a memmap with
+        np.lib.format.open_memmap, or a preallocated (y, x, slices, w) array.
+        By default a new array is allocated.
+    max_workers : int
+        Maximum number of slices decoded concurrently
 
     Returns
     _______
@@ -27,15 +60,38 @@ def load_spect(fn_base, num_imgs=None, ext='.nii.gz'):
         EPSI data as 4D array
     '''
     if num_imgs is None:
-        num_imgs = [f'{i:03d}' for i in range(1, 81)]
-
-    aff, sample = loadnii(fn_base + num_imgs[0] + ext)
-    y, x, w = np.squeeze(sample).shape
-
-    data = np.zeros((y, x, len(num_imgs), w))
-    for i, num in enumerate(num_imgs):
-        data[:, :, i] = np.squeeze(loadnii(fn_base + num + ext)[1])
-
+        num_imgs = _find_slices(fn_base, ext)
+
+    img = nib.load(fn_base + num_imgs[0] + ext)
+    aff = img.affine
+    y, x, w = tuple(n for n in img.shape if n != 1)
+    shape = (y, x, len(num_imgs), w)
+
+    if out is None:
+        data = np.empty(shape, dtype=dtype)
+    elif isinstance(out, str):
+        data = np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                         shape=shape)
+    else:
+        data = out
+        if data.shape != shape:
+            raise ValueError(f'out has shape {data.shape}, expected {shape}')
+
+    def load_slice(i, num):
+        _, sample = loadnii(fn_base + num + ext)
+        sample = np.squeeze(sample)
+        if sample.shape != (y, x, w):
+            raise ValueError(f'Image {num} has shape {sample.shape}, '
+                             f'expected {(y, x, w)}')
+        data[:, :, i] = sample
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for future in [pool.submit(load_slice, i, num)
+                       for i, num in enumerate(num_imgs)]:
+            future.result()
+
+    if isinstance(data, np.memmap):
+        data.flush()
     return aff, data
 
 
@@ -123,41 +179,148 @@ def asym(data, hw=20, method='trapz', include_peak=True):
     return asym
 
 
-def shift_asym(data, hw=20):
+def _center_index(n):
+    '''
+    Index of the spectral center, e.g. 95 for a length of 192
+    '''
+    return n//2 - 1 if n % 2 == 0 else n//2
+
+
+def asym_batch(data, hws=(), levels=(), method='trapz', include_peak=True):
+    '''
+    Computes spectral asymmetry for many half-widths at once. Cumulative
+    integrals along the spectral axis are computed once, after which every
+    half-width costs a few lookups per voxel. Matches asym for each
+    half-width.
+
+    Parameters
+    __________
+    data : ndarray
+        EPSI data. Assumes last axis is spectral
+    hws : sequence of int
+        Half-widths. Number of array indices for integration
+    levels : sequence of float
+        Percentage levels from peak to floor, converted to half-widths with
+        get_hw on data reshaped to voxels x spectral points. Appended after
+        hws.
+    method : 'str'
+        Integration method. 'trapz' or 'sum'.
+    include_peak : bool
+        Whether or not to include peak in integration
+
+    Returns
+    _______
+    asym : ndarray
+        Stacked asymmetry values, of shape (len(hws) + len(levels),) +
+        data.shape[:-1]
+    hws : ndarray
+        Half-width of each map
+    '''
+    if method not in ['trapz', 'sum']:
+        raise ValueError("Method must be 'trapz' or 'sum'")
+
+    n = data.shape[-1]
+    n0 = _center_index(n)
+    hws = list(hws) + [get_hw(data.reshape(-1, n), level)
+                       for level in levels]
+    hws = np.asarray(hws, dtype=int)
+    if hws.size and (hws.min() < 0 or hws.max() > min(n0, n - 1 - n0)):
+        raise ValueError(f'Half-widths must be between 0 and '
+                         f'{min(n0, n - 1 - n0)}')
+
+    # cum[..., k] integrates the first k samples (sum) or from sample 0 to
+    # sample k (trapz), so integrals over ranges are differences of two
+    # lookups
+    zero = np.zeros(data.shape[:-1] + (1,))
+    if method == 'sum':
+        cum = np.concatenate([zero, np.cumsum(data, axis=-1)], axis=-1)
+        lo_range = (n0 - hws, n0 + 1 if include_peak else n0)
+        hi_range = (n0 if include_peak else n0 + 1, n0 + hws + 1)
+    else:
+        seg = (data[..., :-1] + data[..., 1:]) / 2
+        cum = np.concatenate([zero, np.cumsum(seg, axis=-1)], axis=-1)
+        if include_peak:
+            lo_range = (n0 - hws, n0)
+            hi_range = (n0, n0 + hws)
+        else:
+            lo_range = (n0 - hws, np.maximum(n0 - 1, n0 - hws))
+            hi_range = (n0 + 1, np.maximum(n0 + 1, n0 + hws))
+
+    def integral(start, stop):
+        start = np.broadcast_to(start, hws.shape)
+        stop = np.broadcast_to(stop, hws.shape)
+        return np.moveaxis(cum[..., stop] - cum[..., start], -1, 0)
+
+    lo = integral(*lo_range)
+    hi = integral(*hi_range)
+    if include_peak:
+        stop = n0 + hws + 1 if method == 'sum' else n0 + hws
+        t = integral(n0 - hws, stop)
+    else:
+        t = lo + hi
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (hi - lo) / t, hws
+
+
+def shift_asym(data, hw=20, window=20, center=None, chunk_size=2**16):
     '''
-    Computes spectral asymmetry for the given data and half-width.
-    Assumes a length of 192 in spectral dimension, and shifts peak to center
-    before integration. Performs trapezoid integration with peak included.
+    Computes spectral asymmetry for the given data and half-width. Shifts
+    the peak of each spectrum to the center of a window of 2 * window + 1
+    points before integration. Performs trapezoid integration with peak
+    included.
+
+    Windows are gathered from a sliding window view of the spectra with
+    np.take_along_axis, chunk_size voxels at a time. Windows are clipped to
+    the spectrum, so peaks closer than window points to an edge are not
+    exactly centered.
 
     Parameters
     __________
     data : ndarray
-        EPSI data as 4D array. Assumes last axis is spectral and has length 192
+        EPSI data. Assumes last axis is spectral
     hw : int
-        Half-width. Number of array indices for integration
+        Half-width. Number of array indices for integration. At most window.
+    window : int
+        Half-width of the centered window
+    center : int
+        Index that shifts are measured from. Defaults to the spectral center,
+        e.g. 95 for a length of 192.
+    chunk_size : int
+        Number of voxels centered at a time
 
     Returns
     _______
     asym : ndarray
         Array of asymmetry values, after integrating across last dimension
-        in data
+        of the centered spectra
     shifts : ndarray
         Array of shifts, the number of indices the peak was from center
     '''
-    shifted = np.zeros((data.shape[0], 41))
-    shifts = 95 - np.argmax(data, axis=1)
-    for shift in np.unique(shifts):
-        shiftmask = shifts == shift
-        shifted[shiftmask] = data[shiftmask, 95-shift-20:95-shift+20+1]
-    n0 = 20
-
-    lo = data[..., n0-hw:n0+1]
-    hi = data[..., n0:n0+1+hw]
-    t = np.trapz(data[..., n0-hw:n0+1+hw])
-
-    asym = (np.trapz(hi) - np.trapz(lo)) / t
-
-    return asym, shifts
+    n = data.shape[-1]
+    if 2 * window + 1 > n:
+        raise ValueError(f'Window of {2 * window + 1} points is longer than '
+                         f'the spectra ({n})')
+    if not 0 <= hw <= window:
+        raise ValueError('hw must be between 0 and window')
+    if center is None:
+        center = _center_index(n)
+
+    spectra = data.reshape(-1, n)
+    asym = np.zeros(len(spectra))
+    shifts = np.zeros(len(spectra), dtype=int)
+    for i in range(0, len(spectra), chunk_size):
+        chunk = np.asarray(spectra[i:i + chunk_size])
+        peak = np.argmax(chunk, axis=-1)
+        start = np.clip(peak - window, 0, n - 2 * window - 1)
+        windows = sliding_window_view(chunk, 2 * window + 1, axis=-1)
+        centered = np.take_along_axis(windows, start[:, None, None],
+                                      axis=1)[:, 0]
+        asym[i:i + chunk_size] = asym_batch(centered, [hw])[0][0]
+        shifts[i:i + chunk_size] = center - peak
+
+    shape = data.shape[:-1]
+    return asym.reshape(shape), shifts.reshape(shape)
 
 
 def default_signal_noise_masks(n=192, s0=95, ds=5, n0=60, dn=15):
@@ -191,9 +354,75 @@ def default_signal_noise_masks(n=192, s0=95, ds=5, n0=60, dn=15):
     return signal, noise
 
 
+def _levene_pvalues(components, signalmask, noisemask):
+    '''
+    Median-centered (Brown-Forsythe) Levene test for equal variance between
+    the signal and noise regions of every component at once. Matches
+    scipy.stats.levene for each row of components.
+
+    Parameters
+    __________
+    components : ndarray
+        k x w array of principal components
+    signalmask : ndarray
+        Spectral indices corresponding to known signal
+    noisemask : ndarray
+        Spectral indices corresponding to known noise
+
+    Returns
+    _______
+    p : ndarray
+        p-value of each component
+    '''
+    groups = [np.asarray(components[:, signalmask], dtype=np.float64),
+              np.asarray(components[:, noisemask], dtype=np.float64)]
+    dev = [abs(g - np.median(g, axis=1, keepdims=True)) for g in groups]
+    sizes = np.array([d.shape[1] for d in dev])
+    n_total = sizes.sum()
+    means = np.stack([d.mean(1) for d in dev])
+    grand = (means * sizes[:, None]).sum(0) / n_total
+    between = (sizes[:, None] * (means - grand)**2).sum(0)
+    within = sum(((d - m[:, None])**2).sum(1) for d, m in zip(dev, means))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stat = (n_total - 2) * between / within
+    return f_dist.sf(stat, 1, n_total - 2)
+
+
+def _select_components(cov, alpha, signalmask, noisemask, max_rank=None):
+    '''
+    Leading max_rank eigenvectors of a w x w covariance (or scatter) matrix,
+    in descending order of variance, that pass the SSPC Levene test
+    '''
+    Nw = len(cov)
+    max_rank = Nw if max_rank is None else min(int(max_rank), Nw)
+    _, vecs = eigh(cov, subset_by_index=[Nw - max_rank, Nw - 1])
+    components = vecs[:, ::-1].T  # descending variance, as in PCA
+
+    is_sig = _levene_pvalues(components, signalmask, noisemask) <= alpha
+    return components[is_sig]
+
+
+def _sspc_fast(X, alpha, signalmask, noisemask, max_rank=None):
+    '''
+    SSPC denoising of an N x w matrix in float32, using the leading
+    eigenvectors of the w x w covariance matrix. Returns the denoised matrix
+    and the selected components.
+    '''
+    X = np.array(X, dtype=np.float32)
+    mean = X.mean(0)
+    X -= mean
+    selected = _select_components(X.T @ X, alpha, signalmask, noisemask,
+                                  max_rank)
+
+    # Reconstructs from the selected components into the centered copy
+    np.dot(X @ selected.T, selected, out=X)
+    X += mean
+    return X, selected
+
+
 def denoise_SSPC(X, mask=None, alpha=0.5e-3,
                  signalmask=None, noisemask=None,
-                 print_rank=False):
+                 print_rank=False, backend='pca', max_rank=None):
     '''
     This function implements the selection of signal-related principal
     components (SSPC) denoising method for MRSI data.
@@ -220,6 +449,15 @@ def denoise_SSPC(X, mask=None, alpha=0.5e-3,
         Spectral indices corresponding to known noise
     print_rank : bool
         Prints rank
+    backend : str
+        'pca' fits a full sklearn PCA and runs scipy.stats.levene per
+        component. 'fast' computes in float32, takes the leading max_rank
+        eigenvectors of the covariance matrix, tests all components with a
+        vectorized Levene statistic and reconstructs from the selected
+        components only.
+    max_rank : int
+        Upper bound on the number of components considered by the 'fast'
+        backend. Defaults to w.
 
     Returns
     _______
@@ -241,13 +479,27 @@ def denoise_SSPC(X, mask=None, alpha=0.5e-3,
 
     _, Nw = X.shape
 
-    # Fits data to PCs and returns coefficients
-    pca = PCA(n_components=Nw)
-    Z = pca.fit_transform(X)
+    if backend not in ['pca', 'fast']:
+        raise ValueError("Backend must be 'pca' or 'fast'")
 
     if (signalmask is None) & (noisemask is None):
         signalmask, noisemask = default_signal_noise_masks()
 
+    if backend == 'fast':
+        denoised, selected = _sspc_fast(X, alpha, signalmask, noisemask,
+                                        max_rank)
+        if print_rank:
+            print(f'Rank: {len(selected)}')
+        if mask is None:
+            return denoised
+        denoised_data = np.zeros(shape, dtype=np.float32)
+        denoised_data[mask] = denoised
+        return denoised_data
+
+    # Fits data to PCs and returns coefficients
+    pca = PCA(n_components=Nw)
+    Z = pca.fit_transform(X)
+
     # Levene test for equal variance between custom-defined signal
     # and noise frequency regions. Only keep potentially non-consecutive
     # PCs that meach significance alpha.
@@ -267,3 +519,124 @@ def denoise_SSPC(X, mask=None, alpha=0.5e-3,
         print(f'Rank: {is_sig.sum()}')
 
     return denoised_data
+
+
+def _open_source(src):
+    '''
+    Sliceable spectral data from an array, a .npy file (memory mapped) or a
+    NIfTI image (read lazily through its dataobj)
+    '''
+    if not isinstance(src, str):
+        return src
+    if src.endswith('.npy'):
+        return np.load(src, mmap_mode='r')
+    return nib.load(src).dataobj
+
+
+def denoise_SSPC_stream(src, out, mask=None, alpha=0.5e-3, signalmask=None,
+                        noisemask=None, max_rank=None, chunk_size=2**16,
+                        dtype=np.float32, print_rank=False):
+    '''
+    Out-of-core version of denoise_SSPC for datasets that do not fit in
+    memory. The covariance matrix of the spectra is accumulated over chunks
+    of voxels read from the source, its leading eigenvectors are tested as in
+    denoise_SSPC(backend='fast') and a second pass writes the denoised
+    chunks to the output.
+
+    Parameters
+    _________
+    src : str or array
+        Spectroscopic MR data with spectra along the last axis. A .npy
+        filename (memory mapped), a NIfTI filename (read through its
+        dataobj), or an array such as an np.memmap. Chunks are read along
+        the first axis.
+    out : str or array
+        Output .npy filename, created with np.lib.format.open_memmap, or an
+        array with the shape of src
+    mask : array
+        Used to exclude background voxels. Must have as many elements as
+        src.shape[:-1]. Excluded voxels are set to zero.
+    alpha : float
+        Significance level for levene test
+    signalmask : ndarray
+        Spectral indices corresponding to known signal
+    noisemask : ndarray
+        Spectral indices corresponding to known noise
+    max_rank : int
+        Upper bound on the number of components considered. Defaults to w.
+    chunk_size : int
+        Approximate number of voxels read at a time
+    dtype : dtype
+        Data type of a new output file
+    print_rank : bool
+        Prints rank
+
+    Returns
+    _______
+    denoised_data : np.memmap or array
+        Denoised data
+    '''
+    src = _open_source(src)
+    shape = tuple(src.shape)
+    Nw = shape[-1]
+    if mask is not None:
+        mask = np.asarray(mask).astype(bool).reshape(shape[:-1])
+    if (signalmask is None) & (noisemask is None):
+        signalmask, noisemask = default_signal_noise_masks()
+
+    row = int(np.prod(shape[1:-1]))
+    step = max(1, chunk_size // max(row, 1))
+
+    def chunks():
+        for i in range(0, shape[0], step):
+            # Copies, so the in-place second pass never writes to src
+            block = np.array(src[i:i + step], dtype=np.float32, order='C')
+            block = block.reshape(-1, Nw)
+            if mask is not None:
+                block = block[mask[i:i + step].ravel()]
+            yield i, block
+
+    # Accumulates the mean and scatter matrix chunk by chunk, combining
+    # chunk-centered scatter matrices for numerical stability
+    n = 0
+    mean = np.zeros(Nw)
+    scatter = np.zeros((Nw, Nw))
+    for _, block in chunks():
+        if not len(block):
+            continue
+        block_mean = block.mean(0, dtype=np.float64)
+        centered = block - block_mean.astype(np.float32)
+        delta = block_mean - mean
+        total = n + len(block)
+        scatter += centered.T @ centered
+        scatter += np.outer(delta, delta) * n * len(block) / total
+        mean += delta * len(block) / total
+        n = total
+
+    selected = _select_components(scatter, alpha, signalmask, noisemask,
+                                  max_rank).astype(np.float32)
+    if print_rank:
+        print(f'Rank: {len(selected)}')
+
+    if isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                        shape=shape)
+    elif tuple(out.shape) != shape:
+        raise ValueError(f'out has shape {out.shape}, expected {shape}')
+
+    mean = mean.astype(np.float32)
+    for i, block in chunks():
+        block -= mean
+        np.dot(block @ selected.T, selected, out=block)
+        block += mean
+        if mask is None:
+            out[i:i + step] = block.reshape((-1,) + shape[1:])
+        else:
+            slab_mask = mask[i:i + step]
+            slab = np.zeros(slab_mask.shape + (Nw,), dtype=out.dtype)
+            slab[slab_mask] = block
+            out[i:i + step] = slab
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
@@ -0,0 +1,340 @@
+'''
+In-process analyses of memory-mapped .tck files, as lightweight alternatives
+to the following MRTrix3 command line tools:
+
+tckmap
+tck2connectome
+'''
+
+import nibabel as nib
+import numpy as np
+import multiprocessing
+import scipy.sparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .tck import (read_tck_header, tck_index, tck_points, tck_slice,
+                  tck_partition, load_sift2_weights)
+
+_n_cpus = multiprocessing.cpu_count()
+
+
+def _map_chunks(func, ranges, max_workers):
+    '''
+    Yields func(start, stop) for every non-empty range, in completion order,
+    with at most two results per worker pending so that memory stays bounded
+    '''
+    ranges = iter([(a, b) for a, b in ranges if b > a])
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+        while True:
+            for start, stop in ranges:
+                pending.add(pool.submit(func, start, stop))
+                if len(pending) >= 2 * max_workers:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+            del done
+
+
+def _template_geometry(tracks, template=None, vox=None):
+    '''
+    Output affine and shape from a template image, an (aff, shape) tuple, or
+    a voxel size and the bounding box of the streamlines
+    '''
+    if isinstance(template, str):
+        img = nib.load(template)
+        return img.affine, tuple(img.shape[:3])
+    elif template is not None:
+        aff, shape = template
+        return np.asarray(aff, dtype=float), tuple(shape[:3])
+    elif vox is None:
+        raise ValueError('Either template or vox must be given')
+
+    points = tck_points(tracks)
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    for i in range(0, len(points), 2**22):
+        chunk = points[i:i + 2**22]
+        chunk = chunk[np.isfinite(chunk[:, 0])]
+        if len(chunk):
+            lo = np.minimum(lo, chunk.min(0))
+            hi = np.maximum(hi, chunk.max(0))
+    aff = np.diag([vox, vox, vox, 1.])
+    aff[:3, 3] = lo
+    return aff, tuple(np.floor((hi - lo) / vox).astype(int) + 1)
+
+
+def _load_weights(weights):
+    '''
+    Per-streamline weights from an array or a tcksift2 weights file
+    '''
+    if weights is None or not isinstance(weights, str):
+        return weights
+    return load_sift2_weights(weights)
+
+
+def _upsample_ratio(tracks, aff, upsample):
+    '''
+    Upsampling ratio keeping the step below a tenth of the smallest voxel
+    dimension, as tckmap does by default
+    '''
+    if upsample is not None:
+        return max(1, int(upsample))
+
+    header = read_tck_header(tracks)
+    if 'step_size' in header:
+        step = float(header['step_size'])
+    else:
+        points = np.asarray(tck_points(tracks, header)[:10000])
+        seg = np.linalg.norm(np.diff(points, axis=0), axis=1)
+        seg = seg[np.isfinite(seg)]
+        step = np.median(seg) if seg.size else 0
+    min_vox = np.linalg.norm(aff[:3, :3], axis=0).min()
+    return max(1, int(np.ceil(step / (0.1 * min_vox))))
+
+
+def _streamline_ids(points):
+    '''
+    Streamline index, relative to the chunk, of every row of a flat points
+    chunk
+    '''
+    delim = np.isnan(points[:, 0])
+    return np.cumsum(delim) - delim
+
+
+def _voxel_keys(points, sid, inv_aff, shape, upsample):
+    '''
+    Unique (streamline, voxel) keys visited by a chunk of streamlines, after
+    linear upsampling of each segment
+    '''
+    pts, valid = points, ~np.isnan(points[:, 0])
+    if upsample > 1:
+        seg = valid[:-1] & valid[1:]
+        p0 = pts[:-1][seg]
+        step = (pts[1:][seg] - p0) / upsample
+        t = np.arange(1, upsample)[None, :, None]
+        interp = (p0[:, None] + t * step[:, None]).reshape(-1, 3)
+        pts = np.concatenate([pts[valid], interp])
+        sid = np.concatenate([sid[valid],
+                              np.repeat(sid[:-1][seg], upsample - 1)])
+    else:
+        pts, sid = pts[valid], sid[valid]
+
+    vox = np.rint(pts @ inv_aff[:3, :3].T + inv_aff[:3, 3]).astype(np.int64)
+    inside = np.all((vox >= 0) & (vox < shape), axis=1)
+    lin = np.ravel_multi_index(vox[inside].T, shape)
+    nvox = int(np.prod(shape))
+    return np.unique(sid[inside] * nvox + lin)
+
+
+def track_density(tracks, template=None, vox=None, weights=None,
+                  upsample=None, chunk_size=2**16, max_workers=_n_cpus):
+    '''
+    Computes a track density image (TDI) from a .tck file in-process, as a
+    fast alternative to tckmap. Streamlines are upsampled, mapped to the
+    nearest voxel, counted at most once per voxel and accumulated with
+    np.bincount. The file is processed in chunks of streamlines, in parallel.
+
+    Parameters
+    __________
+    tracks : str
+        The input track file.
+    template : str or tuple
+        Template image filename, or (aff, shape), defining the output grid
+    vox : float
+        Isotropic voxel size in mm. Used with the bounding box of the
+        streamlines when no template is given.
+    weights : ndarray or str
+        Per-streamline weights, or a tcksift2 weights file
+    upsample : int
+        Upsampling ratio. By default steps are kept below a tenth of the
+        voxel size, as in tckmap.
+    chunk_size : int
+        Approximate number of points per chunk
+    max_workers : int
+        Maximum number of chunks processed concurrently
+
+    Returns
+    _______
+    aff : ndarray
+        Affine matrix
+    tdi : ndarray
+        Track density image
+    '''
+    aff, shape = _template_geometry(tracks, template, vox)
+    inv_aff = np.linalg.inv(aff)
+    upsample = _upsample_ratio(tracks, aff, upsample)
+    weights = _load_weights(weights)
+    nvox = int(np.prod(shape))
+
+    index = offsets, lengths = tck_index(tracks)
+    all_points = tck_points(tracks)
+    if weights is not None and len(weights) != len(offsets):
+        raise ValueError(f'{len(weights)} weights for {len(offsets)} '
+                         'streamlines')
+
+    n_chunks = int(np.ceil((lengths + 1).sum() / chunk_size))
+    ranges = tck_partition(tracks, n_chunks, index) if n_chunks else []
+
+    def density(start, stop):
+        points, _, _ = tck_slice(tracks, start, stop, index, all_points)
+        points = np.asarray(points, dtype=float)
+        sid = _streamline_ids(points)
+        keys = _voxel_keys(points, sid, inv_aff, shape, upsample)
+        vox, inv = np.unique(keys % nvox, return_inverse=True)
+        w = None if weights is None else weights[start + keys // nvox]
+        return vox, np.bincount(inv, weights=w, minlength=len(vox))
+
+    # Chunks return sparse (voxel, value) pairs, accumulated as they arrive
+    tdi = np.zeros(nvox)
+    for vox, val in _map_chunks(density, ranges, max_workers):
+        tdi[vox] += val
+
+    return aff, tdi.reshape(shape)
+
+
+def _node_image(nodes):
+    '''
+    Affine and integer labels from a parcellation filename or (aff, labels)
+    '''
+    if isinstance(nodes, str):
+        img = nib.load(nodes)
+        aff, labels = img.affine, np.asanyarray(img.dataobj)
+    else:
+        aff, labels = nodes
+    return np.asarray(aff, dtype=float), np.asarray(labels).astype(np.int64)
+
+
+def connectome(tracks, nodes, weights=None, scale_length=False,
+               scale_invlength=False, symmetric=False, zero_diagonal=False,
+               keep_unassigned=False, vector=False, sparse=False,
+               chunk_size=2**20, max_workers=_n_cpus):
+    '''
+    Builds a connectome from a .tck file in-process, as a fast alternative to
+    tck2connectome. Both endpoints of every streamline are assigned to the
+    node label of the voxel containing them (as with tck2connectome
+    -assignment_end_voxels) and edges are accumulated with np.bincount, in
+    parallel over chunks of streamlines.
+
+    Parameters
+    __________
+    tracks : str
+        The input track file.
+    nodes : str or tuple
+        Node parcellation image filename, or (aff, labels). Label 0 is
+        unassigned.
+    weights : ndarray or str
+        Per-streamline weights, or a tcksift2 weights file
+    scale_length : bool
+        Scales each contribution by the streamline length in mm
+    scale_invlength : bool
+        Scales each contribution by the inverse streamline length
+    symmetric : bool
+        Returns a symmetric matrix instead of the upper triangle
+    zero_diagonal : bool
+        Sets the diagonal to zero
+    keep_unassigned : bool
+        Keeps row and column 0 for streamlines with an unassigned endpoint
+    vector : bool
+        Returns a vector where each streamline contributes once to every node
+        containing one of its endpoints
+    sparse : bool
+        Returns a scipy.sparse.csr_matrix instead of a dense array
+    chunk_size : int
+        Approximate number of points per chunk
+    max_workers : int
+        Maximum number of chunks processed concurrently
+
+    Returns
+    _______
+    connectome : ndarray or scipy.sparse.csr_matrix
+        Node x node matrix, or node vector if vector is True. Node k is at
+        index k - 1 unless keep_unassigned is True.
+    '''
+    aff, labels = _node_image(nodes)
+    inv_aff = np.linalg.inv(aff)
+    shape = labels.shape[:3]
+    n = int(labels.max()) + 1
+    weights = _load_weights(weights)
+
+    index = offsets, lengths = tck_index(tracks)
+    all_points = tck_points(tracks)
+    if weights is not None and len(weights) != len(offsets):
+        raise ValueError(f'{len(weights)} weights for {len(offsets)} '
+                         'streamlines')
+
+    def node(points):
+        vox = np.rint(points @ inv_aff[:3, :3].T +
+                      inv_aff[:3, 3]).astype(np.int64)
+        inside = np.all((vox >= 0) & (vox < shape), axis=1)
+        out = np.zeros(len(points), dtype=np.int64)
+        out[inside] = labels[tuple(vox[inside].T)]
+        return out
+
+    def edges(start, stop):
+        points, offs, lens = tck_slice(tracks, start, stop, index,
+                                       all_points)
+        keep = lens > 0
+        offs, lens = offs[keep], lens[keep]
+        ids = np.arange(start, stop)[keep]
+        a = node(np.asarray(points[offs], dtype=float))
+        b = node(np.asarray(points[offs + lens - 1], dtype=float))
+
+        w = np.ones(len(ids)) if weights is None else weights[ids]
+        if scale_length or scale_invlength:
+            points = np.asarray(points, dtype=float)
+            seg = np.linalg.norm(np.diff(points, axis=0), axis=1)
+            valid = ~np.isnan(seg)
+            sid = _streamline_ids(points)[:-1][valid]
+            length = np.bincount(sid, weights=seg[valid],
+                                 minlength=stop - start)[keep]
+            if scale_length:
+                w = w * length
+            if scale_invlength:
+                with np.errstate(divide='ignore'):
+                    w = w * np.where(length > 0, 1 / length, 0)
+
+        if vector:
+            both = np.concatenate([a, np.where(b != a, b, 0)])
+            return both, np.concatenate([w, np.where(b != a, w, 0)])
+        return np.minimum(a, b) * n + np.maximum(a, b), w
+
+    total = (lengths + 1).sum()
+    n_chunks = int(np.ceil(total / chunk_size))
+    ranges = tck_partition(tracks, n_chunks, index) if n_chunks else []
+    size = n if vector else n * n
+    result = np.zeros(size)
+    sparse_parts = []
+    for keys, w in _map_chunks(edges, ranges, max_workers):
+        uniq, inv = np.unique(keys, return_inverse=True)
+        w = np.bincount(inv, weights=w, minlength=len(uniq))
+        if sparse and not vector:
+            sparse_parts.append((uniq, w))
+        else:
+            result[uniq] += w
+
+    first = 0 if keep_unassigned else 1
+    if vector:
+        return result[first:]
+
+    if sparse:
+        keys = np.concatenate([k for k, _ in sparse_parts] + [[]])
+        vals = np.concatenate([v for _, v in sparse_parts] + [[]])
+        keys = keys.astype(np.int64)
+        mat = scipy.sparse.coo_matrix((vals, (keys // n, keys % n)),
+                                      shape=(n, n)).tocsr()
+        if symmetric:
+            mat = mat + scipy.sparse.triu(mat, k=1).T
+        if zero_diagonal:
+            mat.setdiag(0)
+            mat.eliminate_zeros()
+        return mat[first:, first:].tocsr()
+
+    mat = result.reshape(n, n)
+    if symmetric:
+        mat += np.triu(mat, k=1).T
+    if zero_diagonal:
+        np.fill_diagonal(mat, 0)
+    return mat[first:, first:]
@@ -0,0 +1,292 @@
+'''
+Parallel tractography parameter sweeps scored against Allen projections.
+
+For every combination of tckgen parameters and every seed, streamlines are
+generated from the seed region with tckgen, mapped onto the grid of the
+target projection density with tckmap and scored with similarity metrics.
+Scores of completed points are cached on disk, so an interrupted sweep
+resumes where it stopped.
+'''
+
+import os
+import csv
+import json
+import hashlib
+import itertools
+import subprocess
+import numpy as np
+import nibabel as nib
+import scipy.stats
+from concurrent.futures import as_completed
+from .mrtrix import JobScheduler, tckgen, tckmap
+from .ara import get_injection_density, get_projection_density
+
+metric_names = ('pearson', 'spearman', 'cosine', 'dice')
+
+
+def score_density(tdi, target, mask=None, threshold=0):
+    '''
+    Vectorized similarity metrics between track density images and a target
+    projection density.
+
+    Parameters
+    __________
+    tdi : ndarray
+        Track density image with the shape of target, or a stack of them
+        along the first axis
+    target : ndarray
+        Target density, e.g. Allen projection density
+    mask : ndarray
+        Boolean mask of the voxels to compare. Defaults to all finite target
+        voxels.
+    threshold : float
+        Target density above which a voxel counts as projected to, for dice
+
+    Returns
+    _______
+    scores : dict
+        Maps 'pearson', 'spearman', 'cosine' and 'dice' to a float, or to an
+        array with one value per image if tdi is a stack
+    '''
+    target = np.asarray(target, dtype=float)
+    tdi = np.asarray(tdi, dtype=float)
+    single = tdi.ndim == target.ndim
+    if mask is None:
+        mask = np.isfinite(target)
+    mask = np.asarray(mask, dtype=bool)
+
+    y = target[mask]
+    x = tdi.reshape((-1,) + target.shape)[:, mask]
+
+    def pearson(x, y):
+        xc = x - x.mean(-1, keepdims=True)
+        yc = y - y.mean(-1, keepdims=True)
+        denom = np.sqrt((xc**2).sum(-1) * (yc**2).sum(-1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (xc * yc).sum(-1) / denom
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosine = (x @ y) / (np.linalg.norm(x, axis=-1) * np.linalg.norm(y))
+    xb, yb = x > 0, y > threshold
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dice = 2 * (xb & yb).sum(-1) / (xb.sum(-1) + yb.sum())
+
+    scores = {'pearson': pearson(x, y),
+              'spearman': pearson(scipy.stats.rankdata(x, axis=-1),
+                                  scipy.stats.rankdata(y)),
+              'cosine': cosine,
+              'dice': dice}
+    if single:
+        return {key: float(val[0]) for key, val in scores.items()}
+    return scores
+
+
+def _file_id(fn):
+    '''
+    Absolute path, size and modification time of a file
+    '''
+    st = os.stat(fn)
+    return [os.path.abspath(fn), st.st_size, st.st_mtime_ns]
+
+
+def _point_key(name, params, options, settings):
+    '''
+    Short hash identifying a sweep point. settings holds everything else the
+    result depends on: source and seed files, resolution and thresholds.
+    '''
+    point = {'seed': name,
+             'params': {key: str(val) for key, val in sorted(params.items())},
+             'options': {key: str(val)
+                         for key, val in sorted(options.items())},
+             'settings': settings}
+    return hashlib.sha256(json.dumps(point, sort_keys=True)
+                          .encode()).hexdigest()[:16]
+
+
+def _save_atomic(data, aff, fn):
+    tmp = fn.replace('.nii', '.tmp.nii')
+    nib.save(nib.Nifti1Image(data, aff), tmp)
+    os.replace(tmp, fn)
+
+
+def _prepare_seed(name, seed, out_dir, res, seed_threshold):
+    '''
+    Seed mask and target image filenames for a seed definition, writing the
+    Allen injection and projection densities to disk once
+    '''
+    if not isinstance(seed, (int, np.integer)):
+        seed_fn, target_fn = seed
+        return seed_fn, target_fn
+
+    seed_dir = os.path.join(out_dir, 'seeds')
+    os.makedirs(seed_dir, exist_ok=True)
+    seed_fn = os.path.join(seed_dir,
+                           f'{name}_{seed}_{res}_seed{seed_threshold}.nii.gz')
+    target_fn = os.path.join(seed_dir, f'{name}_{seed}_{res}_target.nii.gz')
+    if not os.path.exists(seed_fn):
+        aff, inj = get_injection_density(seed, res)
+        _save_atomic((np.asarray(inj) > seed_threshold).astype(np.uint8),
+                     aff, seed_fn)
+    if not os.path.exists(target_fn):
+        aff, proj = get_projection_density(seed, res)
+        _save_atomic(np.asarray(proj, dtype=np.float32), aff, target_fn)
+    return seed_fn, target_fn
+
+
+def _run_point(source, point_dir, seed_fn, target_fn, params, options,
+               nthreads, exclude_seed, threshold, keep_tracks):
+    '''
+    Runs tckgen and tckmap for one sweep point and scores the TDI
+    '''
+    tracks = os.path.join(point_dir, 'tracks.tck')
+    tdi_fn = os.path.join(point_dir, 'tdi.nii.gz')
+    record = {}
+    for stage, func, args, kwargs in [
+            ('tckgen', tckgen, (source, tracks),
+             {**options, **params, 'seed_image': seed_fn}),
+            ('tckmap', tckmap, (tracks, tdi_fn), {'template': target_fn})]:
+        kwargs.update(force=True, nthreads=nthreads)
+        result = func(*args, **kwargs)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode,
+                                                result.args)
+        record[f'{stage}_wall_time'] = result.wall_time
+        record[f'{stage}_cpu_time'] = result.cpu_time
+
+    target = np.asanyarray(nib.load(target_fn).dataobj)
+    tdi = np.asanyarray(nib.load(tdi_fn).dataobj)
+    mask = np.isfinite(target)
+    if exclude_seed:
+        mask &= np.asanyarray(nib.load(seed_fn).dataobj) == 0
+    record.update(score_density(tdi, target, mask, threshold))
+    if not keep_tracks:
+        os.remove(tracks)
+    return record
+
+
+def run_sweep(source, grid, seeds, out_dir, res=50, nthreads=1,
+              scheduler=None, seed_threshold=0, threshold=0,
+              exclude_seed=True, keep_tracks=False, progress=None,
+              **options):
+    '''
+    Runs a tractography parameter sweep. Every combination of the values in
+    grid is tracked from every seed with tckgen, mapped with tckmap onto the
+    target grid and scored against the target with score_density. Points run
+    concurrently on a JobScheduler. Scores are cached in
+    "{out_dir}/{seed}/{key}/result.json", where key covers the parameters,
+    options, source and seed files, resolution and thresholds, so completed
+    points are skipped when the same sweep is run again.
+
+    Parameters
+    __________
+    source : str
+        The image containing the source data for tckgen, in Allen CCF
+    grid : dict
+        Maps tckgen parameter (e.g. curvature, cutoff, step, minlength) to a
+        list of values
+    seeds : dict
+        Maps seed name to an Allen experiment ID, whose injection density
+        above seed_threshold is the seed mask and whose projection density is
+        the target, or to a (seed image, target image) filename pair
+    out_dir : str
+        Output directory
+    res : int
+        Resolution of the Allen data. Must be 100, 50, 25, or 10.
+    nthreads : int
+        Cores reserved for each point
+    scheduler : JobScheduler
+        Scheduler to run points on. Defaults to a new JobScheduler using all
+        cores.
+    seed_threshold : float
+        Injection density above which a voxel is in the seed mask
+    threshold : float
+        Projection density above which a voxel counts for dice
+    exclude_seed : bool
+        Excludes seed voxels from scoring
+    keep_tracks : bool
+        Keeps the .tck file of each point
+    progress : callable
+        Called as progress(n_done, n_total, row) as each point finishes
+    options : dict
+        Fixed tckgen arguments
+
+    Returns
+    _______
+    rows : list of dict
+        One row per point with the seed, parameters, metrics, tckgen and
+        tckmap wall and CPU times, and status ('cached', 'ran' or 'failed').
+        Also written to "{out_dir}/results.csv".
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    keys = list(grid)
+    points = [dict(zip(keys, vals))
+              for vals in itertools.product(*(grid[key] for key in keys))]
+    seed_files = {name: _prepare_seed(name, seed, out_dir, res,
+                                      seed_threshold)
+                  for name, seed in seeds.items()}
+
+    rows = []
+    todo = {}
+    for name, (seed_fn, target_fn) in seed_files.items():
+        settings = {'source': _file_id(source), 'seed': _file_id(seed_fn),
+                    'target': _file_id(target_fn), 'res': res,
+                    'seed_threshold': seed_threshold, 'threshold': threshold,
+                    'exclude_seed': exclude_seed}
+        for params in points:
+            point_dir = os.path.join(out_dir, name,
+                                     _point_key(name, params, options,
+                                                settings))
+            row = {'seed': name, **params}
+            rows.append(row)
+            try:
+                with open(os.path.join(point_dir, 'result.json')) as f:
+                    row.update(json.load(f), status='cached')
+            except (OSError, ValueError):
+                todo[len(rows) - 1] = (point_dir, seed_fn, target_fn, params)
+
+    own = scheduler is None
+    if own:
+        scheduler = JobScheduler()
+    futures = {}
+    try:
+        for i, (point_dir, seed_fn, target_fn, params) in todo.items():
+            os.makedirs(point_dir, exist_ok=True)
+            future = scheduler.submit(_run_point, source, point_dir, seed_fn,
+                                      target_fn, params, options, nthreads,
+                                      exclude_seed, threshold, keep_tracks,
+                                      cores=nthreads)
+            futures[future] = i
+
+        n_done = len(rows) - len(todo)
+        for future in as_completed(futures):
+            i = futures[future]
+            point_dir = todo[i][0]
+            try:
+                record = future.result()
+            except Exception as err:
+                rows[i].update(status='failed', error=repr(err))
+            else:
+                tmp = os.path.join(point_dir, 'result.json.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump(record, f)
+                os.replace(tmp, os.path.join(point_dir, 'result.json'))
+                rows[i].update(record, status='ran')
+            n_done += 1
+            if progress is not None:
+                progress(n_done, len(rows), rows[i])
+    except BaseException:
+        for future in futures:
+            scheduler.cancel(future)
+        raise
+    finally:
+        if own:
+            scheduler.shutdown(wait=True)
+
+    fields = ['seed'] + keys + list(metric_names)
+    fields += [f'{stage}_{t}' for stage in ('tckgen', 'tckmap')
+               for t in ('wall_time', 'cpu_time')] + ['status', 'error']
+    with open(os.path.join(out_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
@@ -0,0 +1,691 @@
+'''
+Functions for reading and writing MRTrix3 .tck streamline files without
+creating one Python object per streamline.
+
+A .tck file is a text header followed by xyz triplets. Each streamline is
+terminated by a (NaN, NaN, NaN) triplet and the file by (Inf, Inf, Inf).
+Streamlines are represented here as one flat (M, 3) points array, which keeps
+the NaN delimiter rows so that it can be a zero-copy memory map of the file,
+plus offsets and lengths arrays: streamline i is
+points[offsets[i]:offsets[i] + lengths[i]].
+
+The large text outputs of tcksift2 and tck2connectome are loaded through
+binary .npy sidecars (see load_sift2_weights and load_connectome).
+'''
+
+import os
+import re
+import json
+import numpy as np
+
+_dtypes = {'Float32LE': '<f4', 'Float32BE': '>f4',
+           'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+# Header fields summed when merging files, besides count
+_summed_fields = ('total_count', 'max_num_tracks', 'max_num_seeds')
+
+# Width of the zero-padded count field written by TckWriter, so counts can be
+# updated in place
+_count_width = 10
+
+# Comment lines of MRTrix3 text outputs
+_comment_re = re.compile(rb'(?m)^[ \t]*#.*$')
+
+# Lookup of non-whitespace bytes, for counting tokens
+_token_chars = np.ones(256, dtype=bool)
+_token_chars[list(b' \t\r\n')] = False
+
+
+def read_tck_header(fn):
+    '''
+    Reads the header of a .tck file.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+
+    Returns
+    _______
+    header : dict
+        Header fields as strings. Repeated keys are joined by newlines. Also
+        contains 'offset' (int), the byte offset of the data, and 'dtype'
+        (np.dtype) of the stored coordinates.
+    '''
+    header = {}
+    with open(fn, 'rb') as f:
+        if f.readline().strip() != b'mrtrix tracks':
+            raise ValueError(f'{fn} is not an MRtrix tracks file')
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, val = line.partition(':')
+            key, val = key.strip(), val.strip()
+            header[key] = header[key] + '\n' + val if key in header else val
+        else:
+            raise ValueError(f'{fn} has no END in its header')
+
+    header['offset'] = int(header['file'].split()[1])
+    header['dtype'] = np.dtype(_dtypes[header['datatype']])
+    return header
+
+
+def _header_bytes(header, count):
+    '''
+    Serializes a header with a zero-padded count field and a data offset
+    aligned to 16 bytes
+    '''
+    skip = ('file', 'datatype', 'count', 'offset', 'dtype')
+    lines = ['mrtrix tracks']
+    for key, val in header.items():
+        if key not in skip:
+            lines += [f'{key}: {v}' for v in str(val).split('\n')]
+    lines += ['datatype: Float32LE', f'count: {count:0{_count_width}d}']
+
+    text = '\n'.join(lines) + '\nfile: . {}\nEND\n'
+    offset = len(text.format(0))
+    while len(text.format(offset)) > offset:
+        offset = len(text.format(offset))
+    offset = -(-offset // 16) * 16
+    return text.format(offset).encode('latin-1').ljust(offset, b'\0')
+
+
+def tck_points(fn, header=None):
+    '''
+    Memory-maps the coordinate payload of a .tck file.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+    header : dict
+        Header from read_tck_header. Read from fn if None.
+
+    Returns
+    _______
+    points : np.memmap
+        (M, 3) read-only view of all complete triplets, including the NaN
+        delimiter rows and the final Inf row
+    '''
+    if header is None:
+        header = read_tck_header(fn)
+    dtype = header['dtype']
+    n_rows = (os.path.getsize(fn) - header['offset']) // (3 * dtype.itemsize)
+    if n_rows == 0:
+        return np.zeros((0, 3), dtype=dtype)
+    return np.memmap(fn, dtype=dtype, mode='r', offset=header['offset'],
+                     shape=(n_rows, 3))
+
+
+def _scan_delimiters(points, start=0, stop=None, chunk_size=2**24):
+    '''
+    Row indices of NaN delimiters in points[start:stop], scanned in chunks
+    to bound memory
+    '''
+    stop = len(points) if stop is None else stop
+    delims = [np.flatnonzero(np.isnan(points[i:min(i + chunk_size, stop), 0]))
+              + i for i in range(start, stop, chunk_size)]
+    return np.concatenate(delims) if delims else np.zeros(0, dtype=np.intp)
+
+
+def tck_index(fn, rebuild=False):
+    '''
+    Returns the streamline offsets and lengths of a .tck file. The index is
+    built once by a vectorized scan of the NaN delimiters and cached in a
+    "{fn}.idx.npz" sidecar, which is rebuilt when the size or modification
+    time of the .tck file changes.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+    rebuild : bool
+        Rebuilds the sidecar even if it is up to date
+
+    Returns
+    _______
+    offsets : ndarray
+        Row of the first point of each streamline
+    lengths : ndarray
+        Number of points in each streamline
+    '''
+    st = os.stat(fn)
+    idx_fn = fn + '.idx.npz'
+    if not rebuild and os.path.exists(idx_fn):
+        try:
+            with np.load(idx_fn) as idx:
+                if (idx['size'] == st.st_size and
+                        idx['mtime_ns'] == st.st_mtime_ns):
+                    return idx['offsets'], idx['lengths']
+        except (OSError, ValueError, KeyError):
+            pass  # unreadable sidecar, rebuild below
+
+    delims = _scan_delimiters(tck_points(fn))
+    offsets = np.concatenate([[0], delims + 1])[:-1].astype(np.int64)
+    lengths = (delims - offsets).astype(np.int64)
+
+    tmp = f'{idx_fn}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, offsets=offsets, lengths=lengths, size=st.st_size,
+                     mtime_ns=st.st_mtime_ns)
+        os.replace(tmp, idx_fn)
+    except OSError:
+        pass  # read-only location, index is still returned
+    return offsets, lengths
+
+
+def load_tck(fn):
+    '''
+    Loads a .tck file as a memory-mapped flat points array with streamline
+    offsets and lengths (see tck_index). No per-streamline objects are
+    created.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+
+    Returns
+    _______
+    header : dict
+        Header from read_tck_header
+    points : np.memmap
+        (M, 3) coordinates, including NaN delimiter rows
+    offsets : ndarray
+        Row of the first point of each streamline
+    lengths : ndarray
+        Number of points in each streamline
+    '''
+    header = read_tck_header(fn)
+    offsets, lengths = tck_index(fn)
+    return header, tck_points(fn, header), offsets, lengths
+
+
+def _flatten(points, offsets, lengths):
+    '''
+    Gathers the given streamlines into a new contiguous flat array, each
+    followed by a NaN delimiter row
+    '''
+    points = np.asarray(points)
+    offsets = np.asarray(offsets)
+    lengths = np.asarray(lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths + 1)])
+    out = np.full((starts[-1], 3), np.nan, dtype=points.dtype)
+    keep = np.ones(len(out), dtype=bool)
+    keep[starts[1:] - 1] = False
+    rows = np.arange(len(out)) + np.repeat(offsets - starts[:-1], lengths + 1)
+    out[keep] = points[rows[keep]]
+    return out, starts[:-1], lengths
+
+
+def tck_slice(fn, start, stop, index=None, points=None):
+    '''
+    Returns streamlines start to stop (exclusive) of a .tck file as a
+    zero-copy view, using the cached index. Callers slicing the same file
+    repeatedly should pass index and points, which makes each call O(1).
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+    start, stop : int
+        Streamline range
+    index : tuple
+        (offsets, lengths) from tck_index. Loaded if None.
+    points : np.memmap
+        Points from tck_points. Mapped if None.
+
+    Returns
+    _______
+    points : np.memmap
+        (m, 3) coordinates of the range, including NaN rows
+    offsets : ndarray
+        Row of the first point of each streamline, relative to points
+    lengths : ndarray
+        Number of points in each streamline
+    '''
+    offsets, lengths = tck_index(fn) if index is None else index
+    offsets, lengths = offsets[start:stop], lengths[start:stop]
+    if not len(offsets):
+        return np.zeros((0, 3), dtype=np.float32), offsets, lengths
+    if points is None:
+        points = tck_points(fn)
+    first, last = offsets[0], offsets[-1] + lengths[-1] + 1
+    return points[first:last], offsets - first, lengths
+
+
+def tck_sample(fn, k, seed=None):
+    '''
+    Randomly samples k streamlines of a .tck file without replacement.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+    k : int
+        Number of streamlines
+    seed : int
+        Seed for np.random.default_rng
+
+    Returns
+    _______
+    points : ndarray
+        (m, 3) coordinates of the sampled streamlines, including NaN rows
+    offsets : ndarray
+        Row of the first point of each streamline
+    lengths : ndarray
+        Number of points in each streamline
+    ids : ndarray
+        Sorted indices of the sampled streamlines in the file
+    '''
+    offsets, lengths = tck_index(fn)
+    ids = np.sort(np.random.default_rng(seed).choice(len(offsets), k,
+                                                     replace=False))
+    return _flatten(tck_points(fn), offsets[ids], lengths[ids]) + (ids,)
+
+
+def tck_partition(fn, n, index=None):
+    '''
+    Splits a .tck file into n contiguous streamline ranges holding roughly
+    equal numbers of points, e.g. for worker processes calling tck_slice.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+    n : int
+        Number of ranges
+    index : tuple
+        (offsets, lengths) from tck_index. Loaded if None.
+
+    Returns
+    _______
+    ranges : list of tuple
+        (start, stop) streamline ranges covering the file
+    '''
+    _, lengths = tck_index(fn) if index is None else index
+    cum = np.cumsum(lengths + 1)
+    total = cum[-1] if len(cum) else 0
+    bounds = np.searchsorted(cum, total * np.arange(1, n) / n)
+    bounds = np.concatenate([[0], bounds, [len(lengths)]])
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def iter_tck(fn, chunk_size=2**20):
+    '''
+    Iterates over a .tck file in chunks of whole streamlines, reading about
+    chunk_size points at a time. Streamlines longer than chunk_size are
+    returned in a chunk of their own.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+    chunk_size : int
+        Approximate number of points per chunk
+
+    Yields
+    ______
+    points : ndarray
+        Memory-mapped (m, 3) coordinates of the chunk, including NaN rows
+    offsets : ndarray
+        Row of the first point of each streamline, relative to the chunk
+    lengths : ndarray
+        Number of points in each streamline
+    '''
+    points = tck_points(fn)
+    start = 0
+    while start < len(points):
+        stop = min(start + chunk_size, len(points))
+        delims = _scan_delimiters(points, start, stop)
+        while not delims.size and stop < len(points):
+            # Single streamline longer than the chunk
+            stop = min(stop + chunk_size, len(points))
+            delims = _scan_delimiters(points, start, stop)
+        if not delims.size:
+            return
+
+        delims -= start
+        offsets = np.concatenate([[0], delims + 1])[:-1].astype(np.int64)
+        yield points[start:start + delims[-1] + 1], offsets, delims - offsets
+        start += delims[-1] + 1
+
+
+class TckWriter:
+    '''
+    Writes streamlines to a .tck file incrementally. The header count is
+    updated after every append and close writes the terminating Inf triplet.
+    Can be used as a context manager.
+
+    Parameters
+    __________
+    fn : str
+        Track filename
+    header : dict
+        Header fields to write, e.g. from read_tck_header. 'count', 'file'
+        and 'datatype' are managed by the writer.
+    append : bool
+        Appends to an existing file instead of overwriting it
+    '''
+
+    def __init__(self, fn, header=None, append=False):
+        self.fn = fn
+        if append and os.path.exists(fn):
+            head = self._open_existing()
+        else:
+            self.header = dict(header or {})
+            self.count = 0
+            head = _header_bytes(self.header, 0)
+            self._f = open(fn, 'w+b')
+            self._f.write(head)
+        self._count_pos = head.index(b'\ncount: ') + len(b'\ncount: ')
+        self._f.seek(0, os.SEEK_END)
+
+    def _open_existing(self):
+        '''
+        Opens an existing file for appending, dropping its terminating Inf
+        triplet and any incomplete streamline. Files that are not Float32LE or
+        lack a fixed-width count field are first rewritten by streaming.
+        '''
+        header = read_tck_header(self.fn)
+        points = tck_points(self.fn, header)
+        delims = _scan_delimiters(points)
+        end = delims[-1] + 1 if delims.size else 0
+        del points
+
+        self.header = {key: val for key, val in header.items()
+                       if key not in ('offset', 'dtype')}
+        self.count = len(delims)
+        with open(self.fn, 'rb') as f:
+            head = f.read(header['offset'])
+        field = re.search(rb'\ncount: (\d+)\n', head)
+
+        if (header['dtype'] == np.dtype('<f4') and field is not None and
+                len(field.group(1)) == _count_width):
+            self._f = open(self.fn, 'r+b')
+            self._f.truncate(header['offset'] + end * 3 * 4)
+            return head
+
+        tmp = self.fn + '.tmp'
+        head = _header_bytes(self.header, self.count)
+        with open(tmp, 'wb') as out:
+            out.write(head)
+            for pts, _, _ in iter_tck(self.fn):
+                out.write(np.asarray(pts, dtype='<f4').tobytes())
+        os.replace(tmp, self.fn)
+        self._f = open(self.fn, 'r+b')
+        return head
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _update_count(self):
+        pos = self._f.tell()
+        self._f.seek(self._count_pos)
+        self._f.write(f'{self.count:0{_count_width}d}'.encode())
+        self._f.seek(pos)
+
+    def append(self, streamlines):
+        '''
+        Appends streamlines.
+
+        Parameters
+        __________
+        streamlines : iterable of ndarray
+            (n_i, 3) coordinate arrays
+        '''
+        chunk = []
+        for sl in streamlines:
+            chunk += [np.asarray(sl, dtype='<f4').reshape(-1, 3),
+                      np.full((1, 3), np.nan, dtype='<f4')]
+        if chunk:
+            self._f.write(np.concatenate(chunk).tobytes())
+            self.count += len(chunk) // 2
+            self._update_count()
+
+    def append_flat(self, points, offsets, lengths):
+        '''
+        Appends streamlines given in the flat representation of load_tck.
+
+        Parameters
+        __________
+        points : ndarray
+            (M, 3) coordinates
+        offsets : ndarray
+            Row of the first point of each streamline
+        lengths : ndarray
+            Number of points in each streamline
+        '''
+        if not len(offsets):
+            return
+        out, _, _ = _flatten(points, offsets, lengths)
+        self._f.write(np.asarray(out, dtype='<f4').tobytes())
+        self.count += len(offsets)
+        self._update_count()
+
+    def close(self):
+        '''
+        Writes the terminating Inf triplet and closes the file
+        '''
+        if self._f.closed:
+            return
+        self._f.write(np.full(3, np.inf, dtype='<f4').tobytes())
+        self._update_count()
+        self._f.close()
+
+
+def merge_tck(inputs, output, remove=False, chunk_size=2**24):
+    '''
+    Concatenates .tck files by streaming their payloads into a new file with
+    a rewritten header, without loading streamlines into memory. The header
+    of the first input is kept, with count and the total_count,
+    max_num_tracks and max_num_seeds fields summed over the inputs.
+
+    Parameters
+    __________
+    inputs : list of str
+        Input track files
+    output : str
+        Output track file
+    remove : bool
+        Deletes the inputs after a successful merge
+    chunk_size : int
+        Bytes copied per read
+
+    Returns
+    _______
+    count : int
+        Number of streamlines in the output
+    '''
+    headers = [read_tck_header(fn) for fn in inputs]
+    payloads = []
+    for fn, header in zip(inputs, headers):
+        points = tck_points(fn, header)
+        if (header['dtype'] == np.dtype('<f4') and len(points) and
+                np.isinf(points[-1, 0]) and 'count' in header):
+            # Complete MRtrix3 output: trust the count, drop the Inf row
+            payloads.append((int(header['count']), len(points) - 1))
+        else:
+            delims = _scan_delimiters(points)
+            payloads.append((len(delims), delims[-1] + 1 if delims.size
+                             else 0))
+        del points
+
+    merged = {key: val for key, val in headers[0].items()
+              if key not in ('offset', 'dtype')}
+    for field in _summed_fields:
+        if all(field in header for header in headers):
+            merged[field] = str(sum(int(header[field]) for header in headers))
+    count = sum(n for n, _ in payloads)
+
+    tmp = output + '.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(_header_bytes(merged, count))
+        for fn, header, (_, rows) in zip(inputs, headers, payloads):
+            if header['dtype'] == np.dtype('<f4'):
+                remaining = rows * 12
+                with open(fn, 'rb') as f:
+                    f.seek(header['offset'])
+                    while remaining:
+                        chunk = f.read(min(chunk_size, remaining))
+                        if not chunk:
+                            raise IOError(f'{fn} is truncated')
+                        out.write(chunk)
+                        remaining -= len(chunk)
+            else:
+                for pts, _, _ in iter_tck(fn):
+                    out.write(np.asarray(pts, dtype='<f4').tobytes())
+        out.write(np.full(3, np.inf, dtype='<f4').tobytes())
+    os.replace(tmp, output)
+
+    if remove:
+        for fn in inputs:
+            os.remove(fn)
+    return count
+
+
+def _count_tokens(text):
+    '''
+    Number of whitespace separated tokens in a byte string
+    '''
+    data = _token_chars[np.frombuffer(text, dtype=np.uint8)]
+    return int(np.count_nonzero(data[1:] & ~data[:-1]) + data[:1].sum())
+
+
+def _parse_text(fn, chunk_size=2**24):
+    '''
+    Parses a whitespace or comma delimited text matrix with '#' comment
+    lines, chunk by chunk with np.fromstring
+
+    Returns
+    _______
+    values : ndarray
+        Values as a 2D array, one row per line
+    '''
+    values = []
+    tail = b''
+    first = 0
+    ncols = None
+    line_start = True
+    with open(fn, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buf = tail + chunk
+            if chunk:
+                # Cut after the last complete line, or within a long data
+                # line after the last separator, and carry the rest over
+                cut = buf.rfind(b'\n') + 1
+                if not cut:
+                    if line_start and buf.lstrip().startswith(b'#'):
+                        tail = buf
+                        continue
+                    cut = max(buf.rfind(sep) for sep in (b' ', b',', b'\t'))
+                    cut += 1
+                line_start = buf[cut - 1:cut] == b'\n' if cut else line_start
+                buf, tail = buf[:cut], buf[cut:]
+            if b'#' in buf:
+                buf = _comment_re.sub(b'', buf)
+            buf = buf.replace(b',', b' ')
+            if buf.strip():
+                chunk_values = np.fromstring(buf, sep=' ')
+                values.append(chunk_values)
+                if ncols is None:
+                    line = buf if first else buf.lstrip()
+                    end = line.find(b'\n')
+                    if end < 0:
+                        first += len(chunk_values)
+                    else:
+                        ncols = first + _count_tokens(line[:end])
+            if not chunk:
+                break
+
+    values = np.concatenate(values + [np.zeros(0)])
+    ncols = ncols or first or 1
+    if len(values) % ncols:
+        raise ValueError(f'{fn} has rows of unequal length')
+    return values.reshape(-1, ncols)
+
+
+def _cached_text_array(fn, rebuild=False, chunk_size=2**24):
+    '''
+    Parses a text matrix once and caches it in a "{fn}.npy" sidecar, which is
+    memory mapped by later calls and rebuilt when the size or modification
+    time of fn changes. Sidecar metadata is kept in "{fn}.npy.json".
+    '''
+    st = os.stat(fn)
+    npy_fn = fn + '.npy'
+    meta_fn = npy_fn + '.json'
+    stat = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if not rebuild and os.path.exists(meta_fn):
+        try:
+            with open(meta_fn) as f:
+                if json.load(f) == stat:
+                    return np.load(npy_fn, mmap_mode='r')
+        except (OSError, ValueError):
+            pass  # unreadable sidecar, rebuild below
+
+    values = _parse_text(fn, chunk_size)
+    tmp = f'{npy_fn}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, values)
+        os.replace(tmp, npy_fn)
+        with open(tmp, 'w') as f:
+            json.dump(stat, f)
+        os.replace(tmp, meta_fn)
+    except OSError:
+        return values  # read-only location
+    return np.load(npy_fn, mmap_mode='r')
+
+
+def load_sift2_weights(fn, rebuild=False, chunk_size=2**24):
+    '''
+    Loads the per-streamline weights written by tcksift2. The text file is
+    parsed once and cached in a binary "{fn}.npy" sidecar, which later calls
+    memory map. The sidecar is rebuilt when the size or modification time of
+    fn changes.
+
+    Parameters
+    __________
+    fn : str
+        Weights filename
+    rebuild : bool
+        Rebuilds the sidecar even if it is up to date
+    chunk_size : int
+        Number of bytes parsed at a time
+
+    Returns
+    _______
+    weights : np.memmap
+        Weight of each streamline
+    '''
+    return _cached_text_array(fn, rebuild, chunk_size).reshape(-1)
+
+
+def load_connectome(fn, rebuild=False, chunk_size=2**24):
+    '''
+    Loads a connectome matrix written by tck2connectome. The text file is
+    parsed once and cached in a binary "{fn}.npy" sidecar, which later calls
+    memory map. The sidecar is rebuilt when the size or modification time of
+    fn changes.
+
+    Parameters
+    __________
+    fn : str
+        Connectome filename, space or comma delimited
+    rebuild : bool
+        Rebuilds the sidecar even if it is up to date
+    chunk_size : int
+        Number of bytes parsed at a time
+
+    Returns
+    _______
+    connectome : np.memmap
+        Connectome matrix, with one row for a -vector output
+    '''
+    return _cached_text_array(fn, rebuild, chunk_size)
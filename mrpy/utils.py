@@ -1,8 +1,15 @@
 import pickle
 import nibabel as nib
 import numpy as np
+from collections import namedtuple
 from skimage.io import imsave
 
+# Compact mask representations. PackedMask stores one bit per voxel;
+# CroppedMask stores the bounding box of the mask and its offset in the full
+# volume.
+PackedMask = namedtuple('PackedMask', ['bits', 'shape'])
+CroppedMask = namedtuple('CroppedMask', ['data', 'offset', 'shape'])
+
 
 def loadnii(fn):
     '''
@@ -21,11 +28,11 @@ def loadnii(fn):
         Image data
     '''
 
-    if fn.split('.')[-1] not in ['.nii', '.nii.gz']:
+    if not fn.endswith(('.nii', '.nii.gz')):
         raise ValueError('Filename is not .nii or .nii.gz')
 
     img = nib.load(fn)
-    return img.affine, img.get_data()
+    return img.affine, np.asanyarray(img.dataobj)
 
 
 def savenii(data, aff, fn):
@@ -43,7 +50,7 @@ def savenii(data, aff, fn):
 
     '''
 
-    if fn.split('.')[-1] not in ['.nii', '.nii.gz']:
+    if not fn.endswith(('.nii', '.nii.gz')):
         raise ValueError('Filename is not .nii or .nii.gz')
 
     nib.save(nib.Nifti1Image(data, aff), fn)
@@ -64,3 +71,133 @@ def dec2tif(fn):
     data = (255 * (data - data.min()) /
             (data - data.min()).max()).astype(np.uint8)
     imsave(fn.split('.nii')[0] + '.tif', data)
+
+
+def downsample_volume(data, factor, method='mean'):
+    '''
+    Downsamples a 3D volume by an integer factor along each axis by pooling
+    factor^3 blocks. Trailing voxels that do not fill a block are dropped.
+
+    Parameters
+    __________
+    data : ndarray
+        3D image data
+    factor : int
+        Block size along each axis
+    method : str
+        'mean' for block averaging (densities), 'any' or 'majority' for
+        binary masks
+
+    Returns
+    _______
+    pooled : ndarray
+        Downsampled volume. Float for 'mean', bool otherwise.
+    '''
+    if method not in ['mean', 'any', 'majority']:
+        raise ValueError("Method must be 'mean', 'any', or 'majority'")
+
+    f = int(factor)
+    shape = tuple(n // f for n in data.shape)
+    pooled = np.empty(shape, dtype=float if method == 'mean' else bool)
+
+    # Pool one output slab at a time to keep temporaries small
+    for i in range(shape[0]):
+        block = np.asarray(data[i * f:(i + 1) * f, :shape[1] * f,
+                                :shape[2] * f])
+        block = block.reshape(f, shape[1], f, shape[2], f)
+        if method == 'mean':
+            pooled[i] = block.mean(axis=(0, 2, 4))
+        elif method == 'any':
+            pooled[i] = block.any(axis=(0, 2, 4))
+        else:
+            pooled[i] = np.count_nonzero(block, axis=(0, 2, 4)) > f**3 / 2
+    return pooled
+
+
+def mask_bbox(mask):
+    '''
+    Computes the bounding box of the nonzero voxels in a mask.
+
+    Parameters
+    __________
+    mask : ndarray
+        Binary mask
+
+    Returns
+    _______
+    bbox : tuple of slice
+        Slices selecting the bounding box. Empty slices if mask is empty.
+    '''
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        nz = np.flatnonzero(np.any(mask, axis=other))
+        bbox.append(slice(nz[0], nz[-1] + 1) if nz.size else slice(0, 0))
+    return tuple(bbox)
+
+
+def compact_mask(mask, mode='bool'):
+    '''
+    Converts a dense binary mask to a compact representation.
+
+    Parameters
+    __________
+    mask : ndarray
+        Binary mask
+    mode : str
+        'bool' or 'uint8' for a dense array of that type (1 byte/voxel),
+        'packed' for a PackedMask (1 bit/voxel) or 'crop' for a CroppedMask
+        holding only the bounding box of the mask
+
+    Returns
+    _______
+    compact : ndarray, PackedMask or CroppedMask
+        Compact mask. Use dense_mask to convert back to a dense array.
+    '''
+    mask = np.asarray(mask)
+    if mask.dtype != bool:
+        mask = mask != 0
+
+    if mode == 'bool':
+        return mask
+    elif mode == 'uint8':
+        return mask.view(np.uint8)
+    elif mode == 'packed':
+        return PackedMask(np.packbits(mask, axis=None), mask.shape)
+    elif mode == 'crop':
+        bbox = mask_bbox(mask)
+        return CroppedMask(mask[bbox].copy(),
+                           tuple(int(sl.start) for sl in bbox), mask.shape)
+    else:
+        raise ValueError("Mode must be 'bool', 'uint8', 'packed', or 'crop'")
+
+
+def dense_mask(mask, dtype=bool):
+    '''
+    Converts a compact mask from compact_mask back to a dense array.
+
+    Parameters
+    __________
+    mask : ndarray, PackedMask or CroppedMask
+        Compact mask
+    dtype : data-type
+        Output data type
+
+    Returns
+    _______
+    dense : ndarray
+        Dense mask of the full volume shape
+    '''
+    if isinstance(mask, PackedMask):
+        count = int(np.prod(mask.shape))
+        dense = np.unpackbits(mask.bits, count=count).view(bool)
+        dense = dense.reshape(mask.shape)
+    elif isinstance(mask, CroppedMask):
+        dense = np.zeros(mask.shape, dtype=dtype)
+        bbox = tuple(slice(o, o + n)
+                     for o, n in zip(mask.offset, mask.data.shape))
+        dense[bbox] = mask.data
+        return dense
+    else:
+        dense = np.asarray(mask)
+    return dense.astype(dtype, copy=False)
@@ -1,5 +1,5 @@
 import numpy as np
-from .ara import get_mcc
+from .ara import get_structure_index, acronyms_to_ids, descends_from
 import dmritools as dm
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -59,9 +59,7 @@ def connectome_viewer(data, cmap='inferno', ticks=[0, 1], ticklabels=[0, 1],
     # Assumes "data" does not include MDRN or fiber tracts
 
     allen_data = dm.get_connectome()
-    mcc = get_mcc()
-    tree = mcc.get_structure_tree()
-    id_acro_map = tree.get_id_acronym_map()
+    index = get_structure_index()
 
     acros = ['Isocortex', 'OLF', 'HPF', 'CTXsp',
              'STR', 'PAL', 'TH', 'HY', 'MB', 'P', 'MY', 'CB']
@@ -69,13 +67,12 @@ def connectome_viewer(data, cmap='inferno', ticks=[0, 1], ticklabels=[0, 1],
                     for acro in allen_data.columns[5:321] if acro.split('-')[0] not in ['MDRN', 'fiber tracts']]
     ny, nx = data.shape
 
-    source_masks = {}
-    target_masks = {}
-    for acro in acros:
-        source_masks[acro] = np.array([tree.structure_descends_from(
-            id_acro_map[struct], id_acro_map[acro]) for struct in allen_data['primary-injection-structure']])
-        target_masks[acro] = np.array([tree.structure_descends_from(
-            id_acro_map[struct], id_acro_map[acro]) for struct in target_acros])
+    parents = acronyms_to_ids(acros, index)
+    source_desc = descends_from(
+        list(allen_data['primary-injection-structure']), parents, index)
+    target_desc = descends_from(target_acros, parents, index)
+    source_masks = {acro: source_desc[:, i] for i, acro in enumerate(acros)}
+    target_masks = {acro: target_desc[:, i] for i, acro in enumerate(acros)}
 
     colors = {'ipsi': '#d4d8de',
               'contra': '#c0c4cb',